@@ -0,0 +1,176 @@
+"""Local stand-in for 2ch.hk API with synthetic boards.
+
+Serves catalog.json, mobile.fcgi?task=get_thread and file HEAD
+requests with configurable latency and error rate. Can be started
+alone: python -m benchmarks.fake2ch --port 8081
+"""
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+
+class FakeBoard:
+    """Synthetic board with deterministic threads and files."""
+    def __init__(self, name, index, threads, posts, files, video_ratio,
+                 seed):
+        self.name = name
+        rnd = random.Random('{}-{}'.format(seed, name))
+        # Thread ids must be unique between boards
+        base = (index + 1) * 10 ** 7
+        self.threads = {}
+        for t in range(threads):
+            thread_id = base + t * 10000
+            self.threads[thread_id] = [
+                self.make_post(rnd, thread_id, thread_id + p, files,
+                               video_ratio)
+                for p in range(posts)
+            ]
+
+    def make_post(self, rnd, thread_id, num, files, video_ratio):
+        """Get post with random set of files."""
+        post_files = []
+        for i in range(files):
+            ext = 'webm' if rnd.random() < video_ratio else 'jpg'
+            name = '{}{}.{}'.format(num, i, ext)
+            post_files.append({
+                'name': name,
+                'fullname': 'video {} {}.{}'.format(num, i, ext),
+                'path': '/{}/src/{}/{}'.format(self.name, thread_id, name),
+                'thumbnail': '/{}/thumb/{}/{}{}s.jpg'.format(
+                    self.name, thread_id, num, i
+                ),
+                'md5': '{:032x}'.format(rnd.getrandbits(128)),
+                'size': rnd.randint(100, 20000),
+                'width': 1280,
+                'height': 720,
+                'tn_width': 200,
+                'tn_height': 112,
+            })
+        return {
+            'num': num,
+            'timestamp': 1500000000 + num % 10 ** 7,
+            'comment': 'Lorem ipsum dolor sit amet. ' * rnd.randint(1, 40),
+            'files': post_files,
+        }
+
+    def catalog(self):
+        """Get catalog json data."""
+        return {'threads': [{
+            'num': str(thread_id),
+            'subject': 'Thread {}'.format(thread_id),
+            'files_count': sum(len(p['files']) for p in posts),
+            'posts_count': len(posts),
+            'lasthit': posts[-1]['timestamp'],
+        } for thread_id, posts in self.threads.items()]}
+
+
+class FakeServer:
+    """aiohttp application imitating sosach API."""
+    def __init__(self, boards=('b',), threads=50, posts=20, files=2,
+                 video_ratio=0.5, latency=0.0, error_rate=0.0,
+                 missing_rate=0.1, seed=0):
+        self.boards = {name: FakeBoard(name, i, threads, posts, files,
+                                       video_ratio, seed)
+                       for i, name in enumerate(boards)}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get('/{board}/catalog.json', self.catalog),
+            web.get('/makaba/mobile.fcgi', self.thread),
+            web.head('/{board}/src/{thread}/{name}', self.file),
+        ])
+
+    async def simulate(self):
+        """Wait for latency and maybe fail request."""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise web.HTTPInternalServerError()
+
+    def get_board(self, name):
+        if name not in self.boards:
+            raise web.HTTPNotFound()
+        return self.boards[name]
+
+    async def catalog(self, request):
+        await self.simulate()
+        board = self.get_board(request.match_info['board'])
+        # Data never changes, so version is constant
+        etag = '"{}"'.format(board.name)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.json_response(board.catalog(), headers={'ETag': etag})
+
+    async def thread(self, request):
+        await self.simulate()
+        board = self.get_board(request.query.get('board'))
+        try:
+            thread_id = int(request.query['thread'])
+            from_ = int(request.query.get('num', thread_id))
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest()
+        if thread_id not in board.threads:
+            return web.json_response({'Error': 'Thread not found',
+                                      'Code': -3})
+        posts = [p for p in board.threads[thread_id] if p['num'] >= from_]
+        return web.json_response(posts)
+
+    async def file(self, request):
+        await self.simulate()
+        self.get_board(request.match_info['board'])
+        # Same file is always missing or always exists
+        name = request.match_info['name']
+        if random.Random(name).random() < self.missing_rate:
+            raise web.HTTPNotFound()
+        return web.Response()
+
+
+def add_arguments(parser):
+    """Add fake server options to argument parser."""
+    parser.add_argument('--boards', default='b,vg',
+                        help='comma-separated list of boards')
+    parser.add_argument('--threads', type=int, default=50,
+                        help='threads per board')
+    parser.add_argument('--posts', type=int, default=20,
+                        help='posts per thread')
+    parser.add_argument('--files', type=int, default=2,
+                        help='files per post')
+    parser.add_argument('--video-ratio', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--missing-rate', type=float, default=0.1,
+                        help='share of files missing on HEAD check')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args):
+    """Create fake server from parsed arguments."""
+    return FakeServer(
+        boards=[b.strip() for b in args.boards.split(',')],
+        threads=args.threads, posts=args.posts, files=args.files,
+        video_ratio=args.video_ratio, latency=args.latency,
+        error_rate=args.error_rate, missing_rate=args.missing_rate,
+        seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake sosach API server.')
+    add_arguments(parser)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    web.run_app(from_arguments(args).app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compare sequential and concurrent query plans of the video list page.
+
+Usage: python -m benchmarks.list_page --config config.ini [--json]
+"""
+import time
+import json
+import asyncio
+import argparse
+import configparser
+
+from sosachkino.cache import LRUCache
+from sosachkino.db import DB
+from sosachkino.views.videos import VideosView
+
+
+def percentile(values, p):
+    """Get nearest-rank percentile of values."""
+    values = sorted(values)
+    index = max(0, min(len(values) - 1,
+                       int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summary(timings):
+    """Get latency summary in milliseconds."""
+    return {
+        'p50': round(percentile(timings, 50) * 1000, 3),
+        'p99': round(percentile(timings, 99) * 1000, 3),
+        'runs': len(timings),
+    }
+
+
+async def sequential(db, filter_):
+    """Old plan, every query waits for the previous one."""
+    boards = await db.get_boards()
+    videos = [v async for v in db.get_videos(filter_)]
+    count = await db.get_videos_count(filter_)
+    threads = await db.get_threads(filter_)
+    return boards, videos, count, threads
+
+
+async def concurrent(db, filter_):
+    """Plan used by VideosView.list."""
+    return await asyncio.gather(
+        db.get_boards(),
+        VideosView.get_videos(db, filter_),
+        db.get_videos_count(filter_),
+        db.get_threads(filter_)
+    )
+
+
+async def measure(plan, db, filter_, runs):
+    """Run plan several times and get timings."""
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        await plan(db, filter_)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def run(args):
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    # Disable sidebar cache, every run must hit the database
+    db = DB(config['db'], cache=LRUCache(max_size=0))
+    await db.init(None)
+    filter_ = dict(limit=args.limit, offset=0)
+    if args.board:
+        filter_['board'] = args.board
+    results = {}
+    try:
+        for plan in (sequential, concurrent):
+            await measure(plan, db, filter_, args.warmup)
+            timings = await measure(plan, db, filter_, args.runs)
+            results[plan.__name__] = summary(timings)
+    finally:
+        await db.shutdown(None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark video list page queries.'
+    )
+    parser.add_argument('--config', required=True,
+                        help='path to config ini file')
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--limit', type=int, default=VideosView.page_size)
+    parser.add_argument('--board', action='append')
+    parser.add_argument('--json', action='store_true',
+                        help='print machine-readable results')
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results))
+        return
+    for name, result in results.items():
+        print('{:<12} p50 {:>9.3f} ms  p99 {:>9.3f} ms  ({} runs)'.format(
+            name, result['p50'], result['p99'], result['runs']
+        ))
+
+
+if __name__ == '__main__':
+    main()
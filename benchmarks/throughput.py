@@ -0,0 +1,177 @@
+"""Measure updater, cleanup and ingest throughput against fake 2ch.
+
+Tables in configured database are recreated, so never point it to
+production database.
+
+Usage: python -m benchmarks.throughput --config bench.ini --reset-db
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import configparser
+import sqlalchemy as sa
+from aiohttp.test_utils import TestServer
+
+from sosachkino.api import Api
+from sosachkino.db import DB
+from sosachkino.db.models import Files
+from sosachkino.updater import Updater
+from benchmarks import fake2ch
+
+
+async def reset_db(db):
+    """Drop all data from database."""
+    async with db.pools['worker'].acquire() as conn:
+        await conn.execute('TRUNCATE threads, files, counts CASCADE')
+
+
+async def count_files(db):
+    async with db.pools['worker'].acquire() as conn:
+        return await conn.scalar(sa.select([sa.func.count(Files.id)]))
+
+
+async def bench_update(updater, boards, server):
+    """Time single update run of all boards."""
+    requests = server.requests
+    start = time.perf_counter()
+    await updater.update(boards)
+    elapsed = time.perf_counter() - start
+    files = await count_files(updater.db)
+    return {
+        'seconds': round(elapsed, 4),
+        'requests': server.requests - requests,
+        'requests_per_second': round(
+            (server.requests - requests) / elapsed, 2
+        ),
+        'files_total': files,
+    }
+
+
+async def bench_cleanup(updater, server):
+    """Time cleanup run checking every file."""
+    async with updater.db.pools['worker'].acquire() as conn:
+        await conn.execute(
+            sa.update(Files).values(
+                last_check=datetime.datetime.now() -
+                datetime.timedelta(days=30)
+            )
+        )
+    before = await count_files(updater.db)
+    requests = server.requests
+    start = time.perf_counter()
+    await updater.cleanup()
+    elapsed = time.perf_counter() - start
+    checked = server.requests - requests
+    return {
+        'seconds': round(elapsed, 4),
+        'checked': checked,
+        'checks_per_second': round(checked / elapsed, 2),
+        'removed': before - await count_files(updater.db),
+    }
+
+
+def make_files(board, thread_id, count, offset):
+    """Get synthetic api files for ingest benchmark."""
+    return [{
+        'name': '{}{}.webm'.format(thread_id, offset + i),
+        'path': '/{}/src/{}/{}.webm'.format(board, thread_id, offset + i),
+        'thumbnail': '/{}/thumb/{}/{}s.jpg'.format(board, thread_id, i),
+        'md5': '{}-{}-{}'.format(board, thread_id, offset + i),
+        'size': 1000, 'width': 640, 'height': 480,
+        'tn_width': 200, 'tn_height': 150,
+        'board': board, 'thread': thread_id,
+        'timestamp': 1500000000 + i,
+    } for i in range(count)]
+
+
+async def bench_save(db, files_per_thread, threads, staging):
+    """Time saving threads with many files."""
+    start = time.perf_counter()
+    for t in range(threads):
+        thread_id = 900000000 + t
+        thread = {'num': str(thread_id), 'subject': 'bench',
+                  'files_count': files_per_thread}
+        files = make_files('bench', thread_id, files_per_thread,
+                           10 ** 6 if staging else 0)
+        await db.save_thread('bench', thread, thread_id, files, staging)
+    elapsed = time.perf_counter() - start
+    total = files_per_thread * threads
+    return {
+        'seconds': round(elapsed, 4),
+        'files': total,
+        'files_per_second': round(total / elapsed, 2),
+    }
+
+
+async def run(args):
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    config['updater']['concurrency'] = str(args.concurrency)
+    config['cleanup']['concurrency'] = str(args.concurrency)
+    config['cleanup']['limit'] = str(10 ** 9)
+
+    server = fake2ch.from_arguments(args)
+    boards = list(server.boards)
+    results = {'parameters': {
+        k: v for k, v in vars(args).items() if k not in ('config', 'output')
+    }}
+    async with TestServer(server.app) as test_server:
+        api = Api(rate=args.rate, burst=max(int(args.rate), 1))
+        api.base_url = str(test_server.make_url('/'))
+        await api.init(None)
+        db = DB(config['db'])
+        await db.init(None)
+        try:
+            await reset_db(db)
+            updater = Updater(config, api, db)
+            results['update_cold'] = await bench_update(updater, boards,
+                                                        server)
+            results['update_warm'] = await bench_update(updater, boards,
+                                                        server)
+            results['cleanup'] = await bench_cleanup(updater, server)
+            results['save_thread'] = await bench_save(
+                db, args.ingest_files, args.ingest_threads, False
+            )
+            results['save_thread_staging'] = await bench_save(
+                db, args.ingest_files, args.ingest_threads, True
+            )
+        finally:
+            await api.close(None)
+            await db.shutdown(None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark updater and database throughput.'
+    )
+    parser.add_argument('--config', required=True,
+                        help='path to config ini file')
+    parser.add_argument('--reset-db', action='store_true',
+                        help='confirm that database data may be dropped')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='api requests per second, 0 for no limit')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--ingest-files', type=int, default=1000,
+                        help='files per thread in ingest benchmark')
+    parser.add_argument('--ingest-threads', type=int, default=10)
+    parser.add_argument('--output', help='write JSON results to file')
+    fake2ch.add_arguments(parser)
+    args = parser.parse_args()
+    if not args.reset_db:
+        parser.error('benchmark drops all data, pass --reset-db to confirm')
+
+    results = asyncio.run(run(args))
+    data = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        sys.stdout.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ setup(
     author='Vladimir Gorbunov',
     author_email='vsg@suburban.me',
 
-    packages=find_packages(exclude=['docs', 'tests']),
+    packages=find_packages(exclude=['docs', 'tests', 'benchmarks*']),
     install_requires=[
         'aiohttp',
         'aiohttp_jinja2',
@@ -28,6 +28,13 @@ setup(
     ],
 
     extras_require = {
+        'fast': [
+            'ijson >= 3.0',
+            'orjson',
+        ],
+        'metrics': [
+            'prometheus_client',
+        ],
         'testing': [
             'WebTest >= 1.3.1',  # py3 compat
             'pytest',
@@ -37,7 +44,10 @@ setup(
     entry_points = {
         'console_scripts': [
             'sosachkino=sosachkino:main',
+            'sosachkino-worker=sosachkino.worker:main',
             'sosachkino-initdb=sosachkino.db.initdb:initdb',
+            'sosachkino-migrate=sosachkino.db.initdb:migrate',
+            'sosachkino-rebuildcounts=sosachkino.db.initdb:rebuild_counts',
             'sosachkino-printsql=sosachkino.db.initdb:print_sql'
         ],
     },
@@ -7,77 +7,143 @@ import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 
+from sosachkino import metrics
+from sosachkino import server
 from sosachkino.api import Api
+from sosachkino.cache import LRUCache
 from sosachkino.db import DB
+from sosachkino.media import create_media
 from sosachkino.updater import Updater
+from sosachkino.views.api import ApiView
 from sosachkino.views.videos import VideosView
 
 
 logger = logging.getLogger(__name__)
 logging.getLogger('asyncio').setLevel(logging.DEBUG)
 
-def main():
-    """Init all objects and start aiohttp web server."""
-    parser = argparse.ArgumentParser(
-        description='Web-based sosach webm viewer.'
+def create_api(config):
+    """Create API wrapper from config."""
+    return Api(
+        rate=config.getfloat('api', 'rate', fallback=2),
+        burst=config.getint('api', 'burst', fallback=4),
+        json_module=config.get('api', 'json', fallback='json'),
+        streaming=config.getboolean('api', 'streaming', fallback=True)
     )
-    parser.add_argument('--config', default=pathlib.Path.cwd() / 'config.ini',
-                        help='config file (default: ./config.ini)')
-    args = parser.parse_args()
-
-    # Initialize logging
-    logging.config.fileConfig(args.config)
 
-    # Initialize config
-    config = configparser.ConfigParser()
-    config.read(args.config)
 
+def create_app(config):
+    """Init all objects of web application."""
     logger.info('Initializing application')
-    app = web.Application()
+    use_metrics = config.getboolean('app', 'metrics', fallback=True)
+    if use_metrics and not metrics.enabled:
+        logger.warning('prometheus_client is not installed, '
+                       'metrics are disabled')
+        use_metrics = False
+    middlewares = [metrics.middleware] if use_metrics else []
+    app = web.Application(middlewares=middlewares)
     app['config'] = config
 
     jinja_env = aiohttp_jinja2.setup(
         app, loader=jinja2.PackageLoader('sosachkino', 'templates')
     )
 
-    # API wrapper
-    api = Api()
+    # API wrapper, rate limit is shared by everything that uses it
+    api = create_api(config)
     app['api'] = api
 
     # Database
-    db = DB(config['db'])
+    cache = LRUCache(
+        max_size=config.getint('app', 'cache_size', fallback=256),
+        ttl=config.getint('app', 'cache_ttl', fallback=600)
+    )
+    db = DB(config['db'], cache=cache)
     app['db'] = db
 
+    # Local copies of thumbnails and videos
+    media = create_media(config, api)
+    app['media'] = media
+    if media is not None:
+        app['media_url'] = '/media'
+
     # Updater
-    updater = Updater(config, api, db)
+    updater = Updater(config, api, db, media)
     app['updater'] = updater
 
+    # Updater may run in separate sosachkino-worker process, then only
+    # its data changes are received here
+    run_updater = config.getboolean('app', 'updater', fallback=True)
+
     # Init api and database
     app.on_startup.append(db.init)
     app.on_startup.append(api.init)
-    app.on_startup.append(updater.start_task)
+    app.on_startup.append(db.start_listener)
+    if media is not None:
+        app.on_startup.append(media.init)
+    if run_updater:
+        app.on_startup.append(updater.start_task)
 
     # Close them on finish
+    if run_updater:
+        app.on_cleanup.append(updater.cleanup_task)
+    app.on_cleanup.append(db.stop_listener)
+    if media is not None:
+        app.on_cleanup.append(media.close)
     app.on_cleanup.append(api.close)
     app.on_cleanup.append(db.shutdown)
-    app.on_cleanup.append(updater.cleanup_task)
 
     # Routing and views
     videos = VideosView(app)
+    api_view = ApiView(app)
 
     app.add_routes([
-        web.get('/', videos.list, name='videos')
+        web.get('/', videos.list, name='videos'),
+        web.get('/api/videos', api_view.videos, name='api_videos'),
+        web.get('/api/threads', api_view.threads, name='api_threads'),
+        web.get('/api/updater', api_view.updater, name='api_updater'),
     ])
+    if use_metrics:
+        app.router.add_get('/metrics', metrics.handler, name='metrics')
+    if media is not None:
+        app.router.add_get('/media/{path:.+}', media.handler, name='media')
 
     app.router.add_static('/static/',
                           path=pathlib.Path(__file__).parent / 'static',
                           name='static')
 
+    return app
+
+
+def main():
+    """Init config and start aiohttp web server."""
+    parser = argparse.ArgumentParser(
+        description='Web-based sosach webm viewer.'
+    )
+    parser.add_argument('--config', default=pathlib.Path.cwd() / 'config.ini',
+                        help='config file (default: ./config.ini)')
+    parser.add_argument('--workers', type=int,
+                        help='number of web server processes '
+                        '(default: [app] workers or 1)')
+    args = parser.parse_args()
+
+    # Initialize logging
+    logging.config.fileConfig(args.config)
+
+    # Initialize config
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
     # Start server
     host = config['app'].get('host', 'localhost')
     port = int(config['app'].get('port', 8080))
-    logger.info('Starting app on %s:%s', host, port)
-    web.run_app(app, host=host, port=port)
+    workers = args.workers
+    if workers is None:
+        workers = config.getint('app', 'workers', fallback=1)
+    if workers > 1:
+        logger.info('Starting %s workers on %s:%s', workers, host, port)
+        server.run_workers(create_app, config, host, port, workers)
+    else:
+        logger.info('Starting app on %s:%s', host, port)
+        web.run_app(create_app(config), host=host, port=port)
 
 
 if __name__ == '__main__':
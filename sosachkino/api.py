@@ -1,7 +1,18 @@
+import json
+import time
+import asyncio
 import logging
+import importlib
 from urllib.parse import urlencode
 from aiohttp import ClientSession, ClientError
 
+from sosachkino import metrics
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -17,10 +28,61 @@ class ApiError(Exception):
         return '{}, url: {}'.format(err, self.url)
 
 
+def get_loads(name):
+    """Get loads function of JSON module, fallback to stdlib json."""
+    if name == 'json':
+        return json.loads
+    try:
+        return importlib.import_module(name).loads
+    except ImportError:
+        logger.warning('JSON module %s is not installed, using json', name)
+        return json.loads
+
+
+class RateLimiter:
+    """Token bucket limiting request rate to a single host."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        """Add tokens for time passed since last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait until request is allowed by rate limit."""
+        if not self.rate:
+            return
+        # Lock makes waiters get tokens in FIFO order
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
 class Api:
     """Partially implemented sosach API."""
     base_url = 'https://2ch.hk'
 
+    def __init__(self, rate=None, burst=1, json_module='json',
+                 streaming=True):
+        # Shared by all boards and background tasks, so every request
+        # to the host is limited globally
+        self.limiter = RateLimiter(rate, burst)
+        self.loads = get_loads(json_module)
+        # Incremental thread parsing needs ijson
+        self.streaming = streaming and ijson is not None
+        # Last decoded catalog and its validators for every board
+        self.catalogs = {}
+
     async def init(self, app):
         self.session = ClientSession()
 
@@ -52,40 +114,185 @@ class Api:
         return self.get_url(path)
 
     async def get_catalog(self, board):
-        """Get thread list from catalog."""
+        """Get thread list from catalog, None if it wasn't modified."""
         url = self.catalog_url(board)
+        headers = {}
+        cached = self.catalogs.get(board)
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
         logger.debug('Requesting catalog %s', url)
+        await self.limiter.acquire()
         try:
-            async with self.session.get(url) as r:
-                response = await r.json()
-                return response['threads']
+            with metrics.timer(metrics.API_LATENCY, 'catalog'):
+                async with self.session.get(url, headers=headers) as r:
+                    if r.status == 304 and cached is not None:
+                        logger.debug('Catalog %s not modified', url)
+                        return None
+                    response = await r.json(loads=self.loads)
+                    threads = response['threads']
+                    self.catalogs[board] = {
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified'),
+                        'threads': threads,
+                    }
+                    return threads
         except ClientError as e:
             logger.warning('API error: url %s, %s', url, e)
+            metrics.API_ERRORS.labels('catalog').inc()
             raise ApiError(e, url)
 
-    async def get_thread(self, board, thread, from_=None):
-        """Get messages from thread starting with from_ post."""
+    def cached_catalog(self, board):
+        """Get thread list from last downloaded catalog."""
+        cached = self.catalogs.get(board)
+        if cached is None:
+            return None
+        return cached['threads']
+
+    def forget_catalog(self, board):
+        """Remove cached catalog, next request will be unconditional."""
+        self.catalogs.pop(board, None)
+
+    async def iter_thread(self, board, thread, from_=None, file_filter=None):
+        """Get posts from thread starting with from_ post, generator.
+
+        Only num, timestamp and files accepted by file_filter are kept
+        for every post.
+        """
         if from_ is None:
             from_ = thread
         url = self.thread_url(board, thread, from_)
         logger.debug('Requesting thread %s', url)
+        await self.limiter.acquire()
         try:
-            async with self.session.get(url) as r:
-                response = await r.json()
-                return response
+            with metrics.timer(metrics.API_LATENCY, 'thread'):
+                async with self.session.get(url) as r:
+                    r.raise_for_status()
+                    if self.streaming:
+                        posts = self.parse_thread_stream(r.content, url,
+                                                         file_filter)
+                    else:
+                        data = await r.json(loads=self.loads)
+                        posts = self.parse_thread(data, url, file_filter)
+                    async for post in posts:
+                        yield post
         except ClientError as e:
             logger.warning('API error: url %s, %s', url, e)
+            metrics.API_ERRORS.labels('thread').inc()
             raise ApiError(e, url)
+        except ApiError:
+            metrics.API_ERRORS.labels('thread').inc()
+            raise
+
+    async def parse_thread(self, data, url, file_filter=None):
+        """Get posts from decoded thread response, generator."""
+        if isinstance(data, dict):
+            raise ApiError('Response error: {}'.format(data), url)
+        for post in data:
+            files = post.get('files') or []
+            if file_filter is not None:
+                files = [f for f in files if file_filter(f)]
+            yield {
+                'num': post['num'],
+                'timestamp': post['timestamp'],
+                'files': files,
+            }
+
+    async def parse_thread_stream(self, content, url, file_filter=None):
+        """Get posts from thread response while it is downloaded.
+
+        Posts are built from parser events, everything except needed
+        fields (comments, etc) is dropped without building objects.
+        """
+        post = None
+        file_ = None
+        error = None
+        events = ijson.parse_async(content, use_float=True)
+        async for prefix, event, value in events:
+            if prefix == '' and event == 'start_map':
+                error = {}
+            elif error is not None:
+                if prefix in ('Error', 'Code'):
+                    error[prefix] = value
+            elif prefix == 'item':
+                if event == 'start_map':
+                    post = {'files': []}
+                elif event == 'end_map':
+                    yield post
+                    post = None
+            elif post is None:
+                continue
+            elif prefix in ('item.num', 'item.timestamp'):
+                post[prefix[5:]] = value
+            elif prefix == 'item.files.item':
+                if event == 'start_map':
+                    file_ = {}
+                elif event == 'end_map':
+                    if file_filter is None or file_filter(file_):
+                        post['files'].append(file_)
+                    file_ = None
+            elif file_ is not None and prefix.startswith('item.files.item.'):
+                key = prefix[16:]
+                # Nested values aren't used
+                if '.' not in key and event not in ('start_map', 'end_map',
+                                                    'start_array',
+                                                    'end_array', 'map_key'):
+                    file_[key] = value
+        if error is not None:
+            raise ApiError('Response error: {}'.format(error), url)
 
     async def check_file(self, path):
         """Check if file exists at link."""
         url = self.file_url(path)
         logger.debug('Checking file %s', url)
+        await self.limiter.acquire()
         try:
-            async with self.session.head(url, allow_redirects=True) as r:
-                if r.status != 200:
-                    return False
+            with metrics.timer(metrics.API_LATENCY, 'file'):
+                async with self.session.head(url,
+                                             allow_redirects=True) as r:
+                    # Server errors don't mean that file is removed
+                    if r.status >= 500:
+                        r.raise_for_status()
+                    if r.status != 200:
+                        return False
             return True
         except ClientError as e:
             logger.warning('API error: url %s, %s', url, e)
+            metrics.API_ERRORS.labels('file').inc()
+            raise ApiError(e, url)
+
+    async def download(self, path, target, limiter=None):
+        """Save file to target path, get its size or None if missing.
+
+        Other limiter may be passed for requests that shouldn't wait
+        for background ones, shared limiter is used by default.
+        """
+        url = self.file_url(path)
+        logger.debug('Downloading file %s', url)
+        if limiter is None:
+            limiter = self.limiter
+        await limiter.acquire()
+        loop = asyncio.get_event_loop()
+        try:
+            with metrics.timer(metrics.API_LATENCY, 'media'):
+                async with self.session.get(url) as r:
+                    if r.status >= 500:
+                        r.raise_for_status()
+                    if r.status != 200:
+                        return None
+                    size = 0
+                    # Disk writes don't block serving requests
+                    f = await loop.run_in_executor(None, open, target, 'wb')
+                    try:
+                        async for chunk in r.content.iter_chunked(65536):
+                            await loop.run_in_executor(None, f.write, chunk)
+                            size += len(chunk)
+                    finally:
+                        await loop.run_in_executor(None, f.close)
+            return size
+        except ClientError as e:
+            logger.warning('API error: url %s, %s', url, e)
+            metrics.API_ERRORS.labels('media').inc()
             raise ApiError(e, url)
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Size-bounded LRU cache with optional TTL and generation check."""
+    def __init__(self, max_size=256, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation=None, default=None):
+        """Get value if it is cached for the same generation."""
+        item = self.items.get(key)
+        if item is not None:
+            value, item_generation, expires = item
+            if (item_generation == generation and
+                    (expires is None or expires > time.monotonic())):
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            # Stale value will be never used again
+            del self.items[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, generation=None):
+        """Store value, dropping least recently used ones over limit."""
+        expires = None
+        if self.ttl:
+            expires = time.monotonic() + self.ttl
+        self.items[key] = (value, generation, expires)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        """Remove everything from cache."""
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
@@ -1,34 +1,259 @@
 import os
+import re
+import time
 import logging
+import contextlib
+import configparser
 import asyncio
 import datetime
 import pytz
+import aiopg
 import sqlalchemy as sa
 from collections import defaultdict
 from aiopg.sa import create_engine
 from sqlalchemy.dialects import postgresql as pg
 
+from sosachkino import metrics
+from sosachkino.cache import LRUCache
 from sosachkino.db.models import *
+from sosachkino.db.timing import TimedConnection
 
 logger = logging.getLogger(__name__)
 
 
 class DB:
     """Wrapper for sqlite database."""
-    def __init__(self, db_config):
-        self.db_config = db_config
+    # Options handled here, they aren't passed to engine
+    options = ('slow_query', 'explain_slow', 'explain_interval',
+               'auto_migrate',
+               'web_minsize', 'web_maxsize', 'web_acquire_timeout',
+               'web_statement_timeout',
+               'worker_minsize', 'worker_maxsize', 'worker_acquire_timeout',
+               'worker_statement_timeout')
+    # Advisory lock key held by active updater process
+    updater_lock = 0x736b696e6f
+    # Notification channel for data changes
+    channel = 'sosachkino_changed'
+    # Defaults for pools of web requests and background work
+    pool_defaults = {
+        'web': {'minsize': 1, 'maxsize': 10, 'acquire_timeout': 10.0,
+                'statement_timeout': 30.0},
+        'worker': {'minsize': 1, 'maxsize': 5, 'acquire_timeout': 0.0,
+                   'statement_timeout': 0.0},
+    }
+
+    def __init__(self, db_config, cache=None):
+        self.db_config = {k: v for k, v in db_config.items()
+                          if k not in self.options}
+        # Queries slower than this (seconds) are logged, 0 disables it
+        self.slow_query = float(db_config.get('slow_query', 0.5))
+        self.explain_slow = configparser.ConfigParser.BOOLEAN_STATES.get(
+            str(db_config.get('explain_slow', 'false')).lower(), False
+        )
+        # Plans of the same statement are logged once per interval
+        self.explained = LRUCache(
+            ttl=float(db_config.get('explain_interval', 3600))
+        )
+        self.explain_tasks = set()
+        # Apply schema changes needed by code on start
+        self.auto_migrate = configparser.ConfigParser.BOOLEAN_STATES.get(
+            str(db_config.get('auto_migrate', 'true')).lower(), True
+        )
+        self.pool_config = {}
+        for pool, defaults in self.pool_defaults.items():
+            self.pool_config[pool] = {
+                key: type(value)(db_config.get(
+                    '{}_{}'.format(pool, key), value
+                ))
+                for key, value in defaults.items()
+            }
+        self.pools = {}
+        # Number of coroutines waiting for connection in every pool
+        self.waiting = dict.fromkeys(self.pool_defaults, 0)
+        # Cache for rarely changed data, its values are valid only
+        # for the data generation they were read in. Generation is
+        # (epoch, version) from database, so it is the same in every
+        # process for the same data.
+        self.cache = cache if cache is not None else LRUCache()
+        self.generation = (0, 0)
 
     async def init(self, app):
-        """Init database engine."""
+        """Init database engines."""
         logger.info('Initializing database with config %s',
                     dict(self.db_config))
-        self.engine = await create_engine(**self.db_config)
+        if self.auto_migrate:
+            await self.migrate()
+        for pool, config in self.pool_config.items():
+            kwargs = dict(self.db_config)
+            if config['statement_timeout']:
+                kwargs['options'] = '{} -c statement_timeout={}'.format(
+                    kwargs.get('options', ''),
+                    int(config['statement_timeout'] * 1000)
+                ).strip()
+            self.pools[pool] = await create_engine(
+                minsize=config['minsize'], maxsize=config['maxsize'],
+                **kwargs
+            )
+            logger.info('Created %s pool: %s', pool, config)
+        async with self.acquire('load_version') as conn:
+            self.set_generation(await self.load_version(conn))
         logger.info('Database initialized')
 
+    async def migrate(self):
+        """Apply pending migrations that add tables and columns."""
+        from sosachkino.db import migrations
+        loop = asyncio.get_event_loop()
+
+        def run():
+            engine = migrations.create_engine(self.db_config)
+            try:
+                return migrations.migrate(engine, required=True)
+            finally:
+                engine.dispose()
+
+        done = await loop.run_in_executor(None, run)
+        if done:
+            logger.info('Applied migrations: %s', ', '.join(done))
+
+    @property
+    def engine(self):
+        """Engine of web requests pool."""
+        return self.pools['web']
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, method, pool='web'):
+        """Get timed connection from pool for DB method."""
+        engine = self.pools[pool]
+        timeout = self.pool_config[pool]['acquire_timeout'] or None
+        start = time.perf_counter()
+        self.waiting[pool] += 1
+        try:
+            conn = await asyncio.wait_for(engine.acquire(), timeout)
+        except asyncio.TimeoutError:
+            metrics.DB_ACQUIRE_TIMEOUTS.labels(pool).inc()
+            logger.warning('No free connection in %s pool for %s '
+                           'after %s s', pool, method, timeout)
+            raise
+        finally:
+            self.waiting[pool] -= 1
+        metrics.DB_WAIT.labels(method).observe(time.perf_counter() - start)
+        try:
+            yield TimedConnection(conn, method, self)
+        finally:
+            await conn.close()
+
     async def shutdown(self, app):
-        """Close database connection."""
+        """Close database connections."""
         logger.info('Shutting down database')
-        self.engine.close()
+        for task in list(self.explain_tasks):
+            task.cancel()
+        await asyncio.gather(*self.explain_tasks, return_exceptions=True)
+        for engine in self.pools.values():
+            engine.close()
+        for engine in self.pools.values():
+            await engine.wait_closed()
+
+    def set_generation(self, generation):
+        """Mark cached data as outdated when data version changes."""
+        epoch, version = generation
+        # Notifications may come in any order, version never goes back
+        # unless database was recreated
+        if epoch == self.generation[0] and version <= self.generation[1]:
+            return
+        self.generation = (epoch, version)
+        logger.debug('Data generation is %s now', self.version)
+
+    @staticmethod
+    async def load_version(conn):
+        """Get current (epoch, version) of data."""
+        q = sa.select([DataVersion.epoch, DataVersion.version])
+        row = await (await conn.execute(q)).first()
+        return (row[0], row[1]) if row is not None else (0, 0)
+
+    async def notify(self, conn):
+        """Bump data version and tell other processes about it.
+
+        Must run in write transaction, so version changes together with
+        data and notification is sent on commit. Returns new generation.
+        """
+        q = pg.insert(DataVersion).values(id=1, version=1)
+        q = q.on_conflict_do_update(
+            index_elements=[DataVersion.id],
+            set_={'version': DataVersion.version + 1}
+        ).returning(DataVersion.epoch, DataVersion.version)
+        row = await (await conn.execute(q)).first()
+        generation = (row[0], row[1])
+        await conn.execute(sa.select([
+            sa.func.pg_notify(self.channel, '{}-{}'.format(*generation))
+        ]))
+        return generation
+
+    async def listen(self):
+        """Follow data version changes made by all processes."""
+        while True:
+            try:
+                async with aiopg.connect(**self.db_config) as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute('LISTEN {}'.format(self.channel))
+                        # Changes made before LISTEN weren't notified
+                        await cur.execute(
+                            'SELECT epoch, version FROM data_version'
+                        )
+                        row = await cur.fetchone()
+                    if row is not None:
+                        self.set_generation((row[0], row[1]))
+                    logger.info('Listening for data changes')
+                    while True:
+                        msg = await conn.notifies.get()
+                        try:
+                            epoch, version = msg.payload.split('-')
+                            generation = (int(epoch), int(version))
+                        except ValueError:
+                            logger.warning('Bad data change payload: %s',
+                                           msg.payload)
+                            continue
+                        self.set_generation(generation)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('Lost data changes listener connection: %s',
+                               e)
+                await asyncio.sleep(5)
+
+    async def start_listener(self, app):
+        """Start listening for data changes."""
+        app['listener_task'] = asyncio.ensure_future(self.listen())
+
+    async def stop_listener(self, app):
+        """Stop listening for data changes."""
+        app['listener_task'].cancel()
+        try:
+            await app['listener_task']
+        except asyncio.CancelledError:
+            pass
+
+    async def lock_updater(self):
+        """Try to become active updater.
+
+        Returns connection holding the lock, closing it releases lock,
+        or None if other process holds it.
+        """
+        conn = await aiopg.connect(**self.db_config)
+        locked = False
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT pg_try_advisory_lock(%s)',
+                                  (self.updater_lock,))
+                locked = (await cur.fetchone())[0]
+        finally:
+            if not locked:
+                await conn.close()
+        return conn if locked else None
+
+    @property
+    def version(self):
+        """Get identifier of current data version."""
+        return '{}-{}'.format(*self.generation)
 
     async def get_state(self, board, thread_ids=None):
         """Get current saved state for every thread in board."""
@@ -36,37 +261,39 @@ class DB:
         if thread_ids is not None and len(thread_ids):
             q = q.where(Threads.id.in_(thread_ids))
         state = {}
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(q):
+        async with self.acquire('get_state', 'worker') as conn:
+            async for row in await conn.execute(q):
                 state[row['id']] = row
         return state
 
-    async def update_thread_state(self, board, thread, last_id):
-        """Update thread in database after check."""
+    file_keys = ('size', 'width', 'height', 'thumbnail', 'tn_height',
+                 'tn_width', 'path', 'md5', 'thread', 'board')
+
+    def thread_upsert(self, board, thread, last_id):
+        """Get upsert query for thread state."""
         data = dict(
             subject=thread.get('subject', thread['num']),
             last=last_id,
             updated=datetime.datetime.now(),
             files_count=thread['files_count'],
+            posts_count=thread.get('posts_count'),
+            lasthit=thread.get('lasthit'),
             board=board,
             id=int(thread['num'])
         )
-        q = pg.insert(Threads.__table__).values(**data).\
+        return pg.insert(Threads.__table__).values(**data).\
             on_conflict_do_update(
                 constraint='threads_unique',
                 set_=data
             )
-        async with self.engine.acquire() as conn:
-            await conn.execute(q)
 
-    async def save_videos(self, files):
-        """Insert new videos into database."""
+    def file_rows(self, files):
+        """Convert api files to database rows, one row per checksum."""
         timezone = pytz.timezone('Europe/Moscow')
+        rows = {}
         for f in files:
-            keys = ('size', 'width', 'height', 'thumbnail', 'tn_height',
-                    'tn_width', 'path', 'md5', 'thread', 'board')
             name = os.path.splitext(f.get('fullname', f['name']))[0]
-            values = {k: f[k] for k in keys}
+            values = {k: f[k] for k in self.file_keys}
             values.update({
                 'name': name,
                 'timestamp': datetime.datetime.fromtimestamp(
@@ -75,14 +302,184 @@ class DB:
                 ),
                 'id': int(''.join([c for c in f['name'] if c.isdigit()]))
             })
-            q = pg.insert(Files.__table__).values(**values).\
-                on_conflict_do_update(
-                    constraint='files_unique',
-                    set_=values
-                )
             logger.debug('File: board %s, checksum %s', f['board'], f['md5'])
-            async with self.engine.acquire() as conn:
-                await conn.execute(q)
+            # Upsert can't touch same row twice, so keep the last one
+            rows[(values['board'], values['md5'])] = values
+        return list(rows.values())
+
+    def files_upsert(self, query):
+        """Add conflict handling to files insert query."""
+        columns = self.file_keys + ('name', 'timestamp', 'id')
+        return query.on_conflict_do_update(
+            constraint='files_unique',
+            set_={c: query.excluded[c] for c in columns}
+        )
+
+    async def upsert_files(self, conn, files):
+        """Insert or update all files with single query."""
+        rows = self.file_rows(files)
+        q = self.files_upsert(pg.insert(Files.__table__).values(rows))
+        await conn.execute(q)
+
+    async def merge_files(self, conn, files, chunk_size=1000):
+        """Load files into temporary staging table and merge them."""
+        rows = self.file_rows(files)
+        columns = self.file_keys + ('name', 'timestamp', 'id')
+        staging = sa.table('files_staging',
+                           *[sa.column(c) for c in columns])
+        # Psycopg async connections can't COPY, so staging is filled
+        # by large multi-row inserts instead
+        await conn.execute(
+            'CREATE TEMPORARY TABLE files_staging '
+            '(LIKE files INCLUDING DEFAULTS) ON COMMIT DROP'
+        )
+        for i in range(0, len(rows), chunk_size):
+            await conn.execute(
+                staging.insert().values(rows[i:i + chunk_size])
+            )
+        q = pg.insert(Files.__table__).from_select(
+            columns,
+            sa.select([staging.c[c] for c in columns])
+        )
+        await conn.execute(self.files_upsert(q))
+        logger.debug('Merged %s files from staging table', len(rows))
+
+    @staticmethod
+    def ids_param(ids):
+        """Get array parameter for = ANY(...) comparison."""
+        return sa.any_(sa.literal(list(ids), pg.ARRAY(sa.BigInteger)))
+
+    @classmethod
+    def counts_query(cls, thread_ids=None):
+        """Get query recounting files of threads (all when None)."""
+        q = sa.select([
+            Threads.id,
+            Threads.board,
+            sa.func.count(Files.id)
+        ]).select_from(
+            Threads.__table__.outerjoin(Files, Files.thread == Threads.id)
+        ).group_by(Threads.id)
+        if thread_ids is not None:
+            q = q.where(Threads.id == cls.ids_param(thread_ids))
+        insert = pg.insert(Counts.__table__).from_select(
+            ['thread', 'board', 'files'], q
+        )
+        return insert.on_conflict_do_update(
+            index_elements=['thread'],
+            set_=dict(board=insert.excluded.board,
+                      files=insert.excluded.files)
+        )
+
+    async def refresh_counts(self, conn, thread_ids):
+        """Recount files of changed threads."""
+        if not len(thread_ids):
+            return
+        await conn.execute(self.counts_query(thread_ids))
+
+    @classmethod
+    def clusters_query(cls, md5s=None):
+        """Get query choosing newest file of md5 clusters (all when None)."""
+        q = sa.select([
+            Files.md5,
+            Files.id,
+            sa.func.count().over(partition_by=Files.md5)
+        ]).where(Files.md5.isnot(None)).\
+            distinct(Files.md5).\
+            order_by(Files.md5, Files.timestamp.desc(), Files.id.desc())
+        if md5s is not None:
+            q = q.where(Files.md5 == sa.any_(
+                sa.literal(list(md5s), pg.ARRAY(sa.Text))
+            ))
+        insert = pg.insert(Clusters.__table__).from_select(
+            ['md5', 'file', 'reposts'], q
+        )
+        return insert.on_conflict_do_update(
+            index_elements=['md5'],
+            set_=dict(file=insert.excluded.file,
+                      reposts=insert.excluded.reposts)
+        )
+
+    async def refresh_clusters(self, conn, md5s):
+        """Choose newest file and recount reposts of changed md5s.
+
+        Cluster of removed newest file is removed by cascade and
+        created again here if md5 still has files.
+        """
+        if not len(md5s):
+            return
+        await conn.execute(self.clusters_query(md5s))
+
+    async def ingest_files(self, conn, files, staging=False):
+        """Save files and update counts of all affected threads."""
+        threads = {f['thread'] for f in files}
+        # Existing files may move from other threads on conflict
+        q = sa.select([sa.distinct(Files.thread)]).where(
+            sa.tuple_(Files.board, Files.md5).in_(
+                list({(f['board'], f['md5']) for f in files})
+            )
+        )
+        async for row in await conn.execute(q):
+            threads.add(row[0])
+        if staging:
+            await self.merge_files(conn, files)
+        else:
+            await self.upsert_files(conn, files)
+        await self.refresh_counts(conn, threads)
+        await self.refresh_clusters(conn, {f['md5'] for f in files})
+
+    async def save_thread(self, board, thread, last_id, files=(),
+                          staging=False):
+        """Save thread state and its new videos in one transaction."""
+        async with self.acquire('save_thread', 'worker') as conn:
+            async with conn.begin():
+                # Thread must exist before files referencing it
+                await conn.execute(
+                    self.thread_upsert(board, thread, last_id)
+                )
+                if len(files):
+                    await self.ingest_files(conn, files, staging)
+                    generation = await self.notify(conn)
+                else:
+                    await self.refresh_counts(conn, [int(thread['num'])])
+        if len(files):
+            self.set_generation(generation)
+
+    # Files columns needed to show video
+    video_columns = ('id', 'name', 'board', 'thread', 'path', 'thumbnail',
+                     'timestamp', 'size', 'width', 'height', 'md5')
+
+    @staticmethod
+    def search_query(filter_):
+        """Get text search query for q filter, None without words in it.
+
+        Every word matches by prefix, all of them must be found.
+        """
+        words = re.findall(r'[^\W_]+', filter_.get('q', ''))
+        if not len(words):
+            return None
+        return sa.func.to_tsquery(
+            'simple', ' & '.join(w + ':*' for w in words)
+        )
+
+    @staticmethod
+    def search_ids(search):
+        """Get ids of files matching search by name or thread subject."""
+        threads = sa.select([Threads.id]).\
+            where(search_document(Threads.subject).op('@@')(search))
+        # Union lets every part use its own index
+        return sa.union(
+            sa.select([Files.id]).
+            where(search_document(Files.name).op('@@')(search)),
+            sa.select([Files.id]).where(Files.thread.in_(threads))
+        )
+
+    @staticmethod
+    def search_rank(search):
+        """Get relevance of file for search."""
+        return sa.func.greatest(
+            sa.func.ts_rank(search_document(Files.name), search),
+            sa.func.ts_rank(search_document(Threads.subject), search)
+        )
 
     def filter_query(self, query, filter_):
         """Get filtered query for video list."""
@@ -90,29 +487,94 @@ class DB:
             query = query.where(Files.board.in_(filter_['board']))
         if 'thread' in filter_:
             query = query.where(Files.thread.in_(filter_['thread']))
+        search = self.search_query(filter_)
+        if search is not None:
+            query = query.where(Files.id.in_(self.search_ids(search)))
+        if filter_.get('unique') and self.needs_dedupe(filter_):
+            query = query.where(~sa.exists(self.newer_copy(filter_)))
+        return query
+
+    @staticmethod
+    def is_filtered(filter_):
+        """Check if video list is narrowed by board, thread or search."""
+        return any(key in filter_ for key in ('board', 'thread', 'q'))
+
+    def needs_dedupe(self, filter_):
+        """Check if filtered list may have several files of one md5.
+
+        Board (and so thread) has only one file of every md5, see
+        files_unique, so only lists over several of them need it.
+        """
+        if not self.is_filtered(filter_):
+            return False
+        return (len(filter_.get('board', ())) != 1 and
+                len(filter_.get('thread', ())) != 1)
+
+    def newer_copy(self, filter_):
+        """Get query of newer filtered file with the same md5.
+
+        Newest file of md5 cluster may be outside of filter, so
+        filtered lists keep the newest filtered file without
+        grouping all of them, md5 index finds other copies.
+        """
+        other = Files.__table__.alias('other')
+        q = sa.select([sa.literal(1)]).where(other.c.md5 == Files.md5).\
+            where(sa.tuple_(other.c.timestamp, other.c.id) >
+                  sa.tuple_(Files.timestamp, Files.id))
+        if 'board' in filter_:
+            q = q.where(other.c.board.in_(filter_['board']))
+        if 'thread' in filter_:
+            q = q.where(other.c.thread.in_(filter_['thread']))
+        search = self.search_query(filter_)
+        if search is not None:
+            q = q.where(other.c.id.in_(self.search_ids(search)))
+        return q
+
+    def filter_counts(self, query, filter_):
+        """Get query over thread counts filtered like video list."""
+        if 'board' in filter_:
+            query = query.where(Counts.board.in_(filter_['board']))
+        if 'thread' in filter_:
+            query = query.where(Counts.thread.in_(filter_['thread']))
         return query
 
     async def get_videos_count(self, filter_=dict()):
         """Get list of videos with filter."""
-        q = sa.select([sa.func.count(Files.id)]).select_from(Files)
-        q = self.filter_query(q, filter_)
-        async with self.engine.acquire() as conn:
+        if filter_.get('unique') and not self.is_filtered(filter_):
+            q = sa.select([sa.func.count()]).select_from(Clusters)
+        elif (self.search_query(filter_) is not None or
+              (filter_.get('unique') and self.needs_dedupe(filter_))):
+            # Counters know nothing about search and reposts
+            q = sa.select([sa.func.count()]).select_from(Files)
+            q = self.filter_query(q, filter_)
+        else:
+            q = sa.select([sa.func.coalesce(sa.func.sum(Counts.files), 0)])
+            q = self.filter_counts(q, filter_)
+        async with self.acquire('get_videos_count') as conn:
             result = await conn.scalar(q)
         return result
 
-    async def get_threads(self, filter_=dict()):
-        """Get list of threads with videos count."""
-        # Get filter info grouped with file counts
-        q = sa.select([
+    def threads_query(self):
+        """Get query of threads with videos count, most active first."""
+        return sa.select([
             Threads.id,
             Threads.board,
             Threads.subject,
-            sa.func.count(Files.id).label('files')
+            Counts.files
         ]).select_from(
-            Files.__table__.join(Threads, Files.thread == Threads.id)
-        ).having(sa.func.count(Files.id) > 0).\
-        order_by(sa.func.count(Files.id).desc()).\
-        group_by(Threads.id)
+            Counts.__table__.join(Threads, Counts.thread == Threads.id)
+        ).where(Counts.files > 0).\
+        order_by(Counts.files.desc())
+
+    async def get_threads(self, filter_=dict(), limit=None):
+        """Get list of threads with videos count, cached by boards.
+
+        Only limit most active threads are returned besides selected
+        ones, which go first.
+        """
+        q = self.threads_query()
+        if limit is not None:
+            q = q.limit(limit)
 
         # Filter it by our common filter but remove thread param
         filtered = None
@@ -123,110 +585,277 @@ class DB:
                 pass
             filter_ = filter_.copy()
             del filter_['thread']
-        threads = []
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(self.filter_query(q, filter_)):
-                threads.append(dict(row))
+        key = ('threads', tuple(sorted(filter_.get('board', []))), limit)
+        # Data may change while querying, result is cached for the
+        # generation it was read in
+        generation = self.generation
+        threads = self.cache.get(key, generation)
+        if threads is None:
+            threads = []
+            async with self.acquire('get_threads') as conn:
+                async for row in await conn.execute(
+                        self.filter_counts(q, filter_)
+                ):
+                    threads.append(dict(row))
+            self.cache.set(key, threads, generation)
+        threads = list(threads)
         if filtered is not None:
+            # Selected threads may be not active enough to get here
+            missing = set(filtered) - {t['id'] for t in threads}
+            if len(missing):
+                q = self.filter_counts(
+                    self.threads_query(), {'thread': list(missing)}
+                )
+                async with self.acquire('get_threads') as conn:
+                    async for row in await conn.execute(q):
+                        threads.append(dict(row))
             threads = sorted(threads,
                              key=lambda t: (t['id'] in filtered, t['files']),
                              reverse=True)
         return threads
 
+    # Max length of thread number
+    thread_digits = 12
+
+    @classmethod
+    def number_prefix(cls, prefix, max_digits=None):
+        """Get condition matching thread numbers starting with prefix.
+
+        Every possible number length is a range of primary key, prefix
+        longer than max_digits matches nothing.
+        """
+        if max_digits is None:
+            max_digits = cls.thread_digits
+        value = int(prefix)
+        ranges = []
+        for digits in range(len(prefix), max_digits + 1):
+            scale = 10 ** (digits - len(prefix))
+            ranges.append(sa.and_(Threads.id >= value * scale,
+                                  Threads.id < (value + 1) * scale))
+        if not ranges:
+            # Empty or_() adds no condition at all
+            return sa.false()
+        return sa.or_(*ranges)
+
+    async def find_threads(self, prefix, boards=None, limit=20):
+        """Find threads with videos by number or subject words prefix."""
+        prefix = prefix.strip()
+        if prefix.isdigit():
+            if (prefix.startswith('0') or
+                    len(prefix) > self.thread_digits):
+                return []
+            condition = self.number_prefix(prefix)
+        else:
+            search = self.search_query({'q': prefix})
+            if search is None:
+                return []
+            condition = search_document(Threads.subject).op('@@')(search)
+        q = self.threads_query().where(condition).limit(limit)
+        if boards:
+            q = q.where(Counts.board.in_(boards))
+        async with self.acquire('find_threads') as conn:
+            return [dict(row) async for row in await conn.execute(q)]
+
     async def get_videos(self, filter_=dict()):
-        """Get list of videos with filter, generator."""
-        q = sa.select([
-            Files,
-            Threads.subject
-        ]).select_from(
-            Files.__table__.join(Threads, Threads.id == Files.thread)
-        ).order_by(Files.timestamp.desc())
+        """Get list of videos with filter, generator.
+
+        Filter may contain after or before (timestamp, id) position
+        for keyset pagination instead of offset. Search results
+        without position are sorted by relevance and have rank column.
+        Unique filter collapses reposts of the same file to the newest
+        one with reposts column, counted over all boards.
+        """
+        columns = [Files.__table__.c[c] for c in self.video_columns]
+        columns.append(Threads.subject)
+        source = Files.__table__.join(Threads, Threads.id == Files.thread)
+        if filter_.get('unique'):
+            columns.append(Clusters.reposts)
+            if self.is_filtered(filter_):
+                # Files are deduplicated by filter_query if needed,
+                # cluster only gives reposts count
+                source = source.outerjoin(Clusters,
+                                          Clusters.md5 == Files.md5)
+            else:
+                source = source.join(Clusters, Clusters.file == Files.id)
+        search = self.search_query(filter_)
+        ranked = (search is not None and 'after' not in filter_ and
+                  'before' not in filter_)
+        if ranked:
+            rank = self.search_rank(search)
+            columns.append(rank.label('rank'))
+        q = sa.select(columns).select_from(source)
         q = self.filter_query(q, filter_)
+        position = sa.tuple_(Files.timestamp, Files.id)
+        reverse = False
+        if 'after' in filter_:
+            q = q.where(position < sa.tuple_(*filter_['after']))
+        elif 'before' in filter_:
+            # Walk back from position, result is reversed below
+            q = q.where(position > sa.tuple_(*filter_['before']))
+            reverse = True
+        if ranked:
+            q = q.order_by(sa.desc('rank'),
+                           Files.timestamp.desc(), Files.id.desc())
+        elif reverse:
+            q = q.order_by(Files.timestamp.asc(), Files.id.asc())
+        else:
+            q = q.order_by(Files.timestamp.desc(), Files.id.desc())
         if 'limit' in filter_:
             q = q.limit(filter_['limit'])
         if 'offset' in filter_:
             q = q.offset(filter_['offset'])
 
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(q):
-                yield dict(row)
+        async with self.acquire('get_videos') as conn:
+            if reverse:
+                rows = [row async for row in await conn.execute(q)]
+                for row in reversed(rows):
+                    yield row
+                return
+            async for row in await conn.execute(q):
+                yield row
+
+    async def iter_videos(self, filter_=dict(), chunk_size=500):
+        """Get all videos with filter by keyset chunks, generator.
+
+        Psycopg async connections have no server-side cursors, so
+        rows are read in chunks, every chunk continues from the
+        last row of the previous one. Connection isn't held while
+        rows are consumed. Search results sorted by relevance have no
+        position, so they are read by offset.
+        """
+        filter_ = filter_.copy()
+        remaining = filter_.pop('limit', None)
+        filter_.pop('offset', None)
+        filter_.pop('before', None)
+        ranked = (self.search_query(filter_) is not None and
+                  'after' not in filter_)
+        offset = 0
+        while remaining is None or remaining > 0:
+            size = chunk_size
+            if remaining is not None:
+                size = min(chunk_size, remaining)
+                remaining -= size
+            filter_['limit'] = size
+            if ranked:
+                filter_['offset'] = offset
+                offset += size
+            rows = [row async for row in self.get_videos(filter_)]
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                return
+            if not ranked:
+                filter_['after'] = (rows[-1]['timestamp'], rows[-1]['id'])
 
     async def set_removed(self, board, thread_ids):
         """Set removed date for threads that don't exist in catalog now."""
         logger.debug('Marking old threads as removed, board: /%s/', board)
-        async with self.engine.acquire() as conn:
-            await conn.execute(
-                sa.update(Threads)
-                .where(~Threads.id.in_(thread_ids))
-                .where(Threads.removed_date == None)
-                .where(Threads.board == board)
-                .values(removed_date=datetime.datetime.now())
-            )
+        async with self.acquire('set_removed', 'worker') as conn:
+            async with conn.begin():
+                result = await conn.execute(
+                    sa.update(Threads)
+                    .where(~Threads.id.in_(thread_ids))
+                    .where(Threads.removed_date == None)
+                    .where(Threads.board == board)
+                    .values(removed_date=datetime.datetime.now())
+                )
+                if result.rowcount:
+                    generation = await self.notify(conn)
+        if result.rowcount:
+            self.set_generation(generation)
 
     async def get_boards(self):
         """Get list of existing boards."""
+        generation = self.generation
+        boards = self.cache.get(('boards',), generation)
+        if boards is not None:
+            return list(boards)
         boards = set()
         q = sa.select([sa.distinct(Threads.board)])
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(q):
+        async with self.acquire('get_boards') as conn:
+            async for row in await conn.execute(q):
                 boards.add(row[0])
-        return sorted(boards)
+        boards = sorted(boards)
+        self.cache.set(('boards',), boards, generation)
+        return list(boards)
 
-    async def get_removed_thread_check(self, from_date):
+    async def get_removed_thread_check(self, from_date, limit=None):
         """Get files from removed threads that need checking."""
         q = sa.select([Files]).select_from(
             Files.__table__.join(Threads, Threads.id == Files.thread)
         ).where(Threads.removed_date < datetime.datetime.now()).\
         where(Files.last_check < from_date).\
         order_by(Files.last_check.asc())
+        if limit is not None:
+            q = q.limit(limit)
         files = []
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(q):
+        async with self.acquire('get_removed_thread_check', 'worker') as conn:
+            async for row in await conn.execute(q):
                 files.append(dict(row))
         logger.debug('Found %s potentially missing files', len(files))
         return files
 
-    async def get_files_to_check(self, from_date):
+    async def get_files_to_check(self, from_date, limit=60):
         """Get files that just need check."""
         # Check newer files first
         q = sa.select([Files]).\
             where(Files.last_check < from_date).\
             order_by(Files.last_check.desc()).\
-            limit(60)      # Don't check everything in one run
+            limit(limit)      # Don't check everything in one run
         files = []
-        async with self.engine.acquire() as conn:
-            async for row in conn.execute(q):
+        async with self.acquire('get_files_to_check', 'worker') as conn:
+            async for row in await conn.execute(q):
                 files.append(dict(row))
         logger.debug('Got %s old files', len(files))
         return files
 
-    async def remove_file(self, file_id):
-        """Remove file from database."""
-        logger.debug('Removing file %s', file_id)
-        async with self.engine.acquire() as conn:
-            await conn.execute(
-                sa.delete(Files).where(Files.id == file_id)
-            )
+    async def remove_files(self, file_ids):
+        """Remove files from database."""
+        if not len(file_ids):
+            return
+        logger.debug('Removing %s files', len(file_ids))
+        async with self.acquire('remove_files', 'worker') as conn:
+            async with conn.begin():
+                q = sa.delete(Files).\
+                    where(Files.id == self.ids_param(file_ids)).\
+                    returning(Files.thread, Files.md5)
+                rows = [row async for row in await conn.execute(q)]
+                threads = {row[0] for row in rows}
+                await self.refresh_counts(conn, threads)
+                await self.refresh_clusters(conn, {row[1] for row in rows})
+                if len(threads):
+                    generation = await self.notify(conn)
+        if len(threads):
+            self.set_generation(generation)
 
-    async def update_checked(self, file_id):
-        """Remove file from database."""
-        logger.debug('Update last check for file %s', file_id)
-        async with self.engine.acquire() as conn:
+    async def update_checked(self, file_ids):
+        """Update last check time for files."""
+        if not len(file_ids):
+            return
+        logger.debug('Update last check for %s files', len(file_ids))
+        async with self.acquire('update_checked', 'worker') as conn:
             await conn.execute(
-                sa.update(Files).where(Files.id == file_id)
+                sa.update(Files).where(Files.id == self.ids_param(file_ids))
                 .values(last_check=datetime.datetime.now())
             )
 
     async def clean_threads(self):
         """Remove threads without files from database."""
         logger.debug('Cleaning old threads')
-        async with self.engine.acquire() as conn:
-            await conn.execute(
-                sa.delete(Threads).where(Threads.id.in_(
-                    sa.select([Threads.id]).select_from(
-                        Threads.__table__.outerjoin(Files, Files.thread == Threads.id)
-                    ).where(Threads.removed_date.isnot(None))
-                    .group_by(Threads.id)
-                    .having(sa.func.count(Files.id) == 0))
+        async with self.acquire('clean_threads', 'worker') as conn:
+            async with conn.begin():
+                result = await conn.execute(
+                    sa.delete(Threads).where(Threads.id.in_(
+                        sa.select([Threads.id]).select_from(
+                            Threads.__table__.outerjoin(
+                                Files, Files.thread == Threads.id
+                            )
+                        ).where(Threads.removed_date.isnot(None))
+                        .group_by(Threads.id)
+                        .having(sa.func.count(Files.id) == 0))
+                    )
                 )
-            )
+                if result.rowcount:
+                    generation = await self.notify(conn)
+        if result.rowcount:
+            self.set_generation(generation)
@@ -6,6 +6,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.engine import url
 from sqlalchemy.dialects import postgresql
 
+from sosachkino.db import DB
+from sosachkino.db import migrations
 from sosachkino.db.base import Base, Meta
 from sosachkino.db.models import *
 
@@ -30,6 +32,8 @@ def initdb():
     conf = config['db']
     conf['username'] = config['db']['user']
     del conf['user']
+    for option in DB.options:
+        conf.pop(option, None)
 
     logger.info('Creating engine')
     engine = create_engine(url.URL(drivername='postgres', **config['db']))
@@ -38,6 +42,86 @@ def initdb():
     Meta.drop_all(engine)
     logger.info('Creating tables')
     Meta.create_all(engine)
+    # New schema already has everything migrations add
+    with engine.begin() as conn:
+        migrations.mark_applied(
+            conn, [name for name, func, tr in migrations.MIGRATIONS]
+        )
+    logger.info('Finished')
+
+
+def migrate():
+    """Apply schema changes to existing database."""
+    parser = argparse.ArgumentParser(
+        description='Update sosachkino database schema keeping data.'
+    )
+    parser.add_argument('--config', required=True,
+                        help='path to config ini file')
+    parser.add_argument('--list', action='store_true',
+                        help='only show migrations state')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(args.config)
+    logger = logging.getLogger(__name__)
+    logger.info('Loading config file')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    # An hack
+    conf = config['db']
+    conf['username'] = config['db']['user']
+    del conf['user']
+    for option in DB.options:
+        conf.pop(option, None)
+
+    logger.info('Creating engine')
+    engine = create_engine(url.URL(drivername='postgres', **config['db']))
+
+    if args.list:
+        applied = migrations.get_applied(engine)
+        for name, func, transaction in migrations.MIGRATIONS:
+            print('{} {}'.format('+' if name in applied else '-', name))
+        return
+    done = migrations.migrate(engine)
+    logger.info('Finished, applied %s migrations', len(done))
+
+
+def rebuild_counts():
+    """Recount files of every thread and reposts of every md5."""
+    parser = argparse.ArgumentParser(
+        description='Rebuild sosachkino thread files counters '
+        'and md5 clusters.'
+    )
+    parser.add_argument('--config', required=True,
+                        help='path to config ini file')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(args.config)
+    logger = logging.getLogger(__name__)
+    logger.info('Loading config file')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    # An hack
+    conf = config['db']
+    conf['username'] = config['db']['user']
+    del conf['user']
+    for option in DB.options:
+        conf.pop(option, None)
+
+    logger.info('Creating engine')
+    engine = create_engine(url.URL(drivername='postgres', **config['db']))
+
+    logger.info('Counting files')
+    Counts.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(DB.counts_query())
+    logger.info('Clustering files by md5')
+    Clusters.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(DB.clusters_query())
     logger.info('Finished')
 
 
@@ -60,6 +144,8 @@ def print_sql():
     conf = config['db']
     conf['username'] = config['db']['user']
     del conf['user']
+    for option in DB.options:
+        conf.pop(option, None)
 
     def metadata_dump(sql, *multiparams, **params):
         print(sql.compile(dialect=postgresql.dialect()))
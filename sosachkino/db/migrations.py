@@ -0,0 +1,153 @@
+import logging
+import sqlalchemy as sa
+from sqlalchemy.engine import url
+from sqlalchemy.schema import CreateIndex
+
+from sosachkino.db import DB
+from sosachkino.db.models import *
+
+logger = logging.getLogger(__name__)
+
+
+def get_index(model, name):
+    """Get index of model by name."""
+    for index in model.__table__.indexes:
+        if index.name == name:
+            return index
+    raise KeyError(name)
+
+
+def create_index(conn, index):
+    """Create index without blocking writes to table."""
+    valid = conn.execute(sa.text(
+        'SELECT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name'
+    ), name=index.name).scalar()
+    # Interrupted concurrent build leaves invalid index
+    if valid is False:
+        logger.info('Dropping invalid index %s', index.name)
+        conn.execute('DROP INDEX CONCURRENTLY {}'.format(index.name))
+    sql = str(CreateIndex(index).compile(dialect=conn.dialect))
+    logger.info('Creating index %s', index.name)
+    conn.execute(sql.replace(
+        'CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1
+    ))
+
+
+def thread_activity(conn):
+    """Add catalog activity fields to threads."""
+    conn.execute('ALTER TABLE threads '
+                 'ADD COLUMN IF NOT EXISTS posts_count integer, '
+                 'ADD COLUMN IF NOT EXISTS lasthit bigint')
+
+
+def counts(conn):
+    """Add files counters of threads and fill them."""
+    Counts.__table__.create(conn, checkfirst=True)
+    conn.execute(DB.counts_query())
+
+
+def keyset_index(conn):
+    """Add index for keyset pagination."""
+    create_index(conn, get_index(Files, 'ix_files_timestamp_id'))
+
+
+def query_indexes(conn):
+    """Add indexes for filtered lists and cleanup."""
+    for name in ('ix_files_board_timestamp_id',
+                 'ix_files_thread_timestamp_id',
+                 'ix_files_thread_last_check'):
+        create_index(conn, get_index(Files, name))
+    create_index(conn, get_index(Threads, 'ix_threads_removed_date'))
+
+
+def search_indexes(conn):
+    """Add text search indexes of video names and thread subjects."""
+    create_index(conn, get_index(Files, 'ix_files_name_search'))
+    create_index(conn, get_index(Threads, 'ix_threads_subject_search'))
+
+
+def clusters(conn):
+    """Add md5 clusters for collapsing reposts and fill them."""
+    Clusters.__table__.create(conn, checkfirst=True)
+    conn.execute(DB.clusters_query())
+
+
+def data_version(conn):
+    """Add shared data version."""
+    DataVersion.__table__.create(conn, checkfirst=True)
+
+
+# Name, function and if it runs in transaction, concurrent index
+# builds can't
+MIGRATIONS = (
+    ('0001_thread_activity', thread_activity, True),
+    ('0002_counts', counts, True),
+    ('0003_keyset_index', keyset_index, False),
+    ('0004_query_indexes', query_indexes, False),
+    ('0005_search_indexes', search_indexes, False),
+    ('0006_clusters', clusters, True),
+    ('0007_data_version', data_version, True),
+)
+
+
+# Advisory lock key held while migrations are applied
+LOCK = 0x736b696d6967
+
+
+def create_engine(db_config):
+    """Create synchronous engine from [db] config section."""
+    conf = {k: v for k, v in db_config.items() if k not in DB.options}
+    conf['username'] = conf.pop('user', None)
+    return sa.create_engine(url.URL(drivername='postgres', **conf))
+
+
+def get_applied(engine):
+    """Get names of migrations applied to database."""
+    SchemaMigrations.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {row[0] for row in
+                conn.execute(sa.select([SchemaMigrations.name]))}
+
+
+def mark_applied(conn, names):
+    """Record migrations as applied."""
+    if len(names):
+        conn.execute(SchemaMigrations.__table__.insert(),
+                     [{'name': name} for name in names])
+
+
+def migrate(engine, required=False):
+    """Apply migrations missing in database, get their names.
+
+    With required only schema changes code can't work without are
+    applied, concurrent index builds are left for sosachkino-migrate.
+    """
+    with engine.connect() as lock:
+        # Processes starting at once apply migrations one by one
+        lock.execute(sa.select([sa.func.pg_advisory_lock(LOCK)]))
+        try:
+            return apply(engine, required)
+        finally:
+            lock.execute(sa.select([sa.func.pg_advisory_unlock(LOCK)]))
+
+
+def apply(engine, required):
+    """Apply missing migrations, lock must be held."""
+    applied = get_applied(engine)
+    done = []
+    for name, func, transaction in MIGRATIONS:
+        if name in applied or (required and not transaction):
+            continue
+        logger.info('Applying migration %s', name)
+        if transaction:
+            with engine.begin() as conn:
+                func(conn)
+                mark_applied(conn, [name])
+        else:
+            with engine.connect() as conn:
+                func(conn.execution_options(isolation_level='AUTOCOMMIT'))
+            with engine.begin() as conn:
+                mark_applied(conn, [name])
+        done.append(name)
+    return done
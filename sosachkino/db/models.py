@@ -3,6 +3,13 @@ import sqlalchemy as sa
 from sosachkino.db.base import Base
 
 
+def search_document(column):
+    """Get text search document of column, file name parts are words."""
+    return sa.func.to_tsvector('simple', sa.func.regexp_replace(
+        sa.func.coalesce(column, ''), '[_.-]+', ' ', 'g'
+    ))
+
+
 class Threads(Base):
     """Model for thread, cleaned up when missing from json."""
     id = sa.Column(sa.BigInteger, primary_key=True, autoincrement=False)
@@ -10,11 +17,18 @@ class Threads(Base):
     subject = sa.Column(sa.Text)
     last = sa.Column(sa.Integer)
     files_count = sa.Column(sa.Integer)
+    posts_count = sa.Column(sa.Integer)
+    lasthit = sa.Column(sa.BigInteger)
     updated = sa.Column(sa.DateTime(timezone=True))
     removed_date = sa.Column(sa.DateTime(timezone=True))
 
     __table_args__ = (
         sa.UniqueConstraint('id', 'board', name='threads_unique'),
+        # Cleanup looks only for removed threads
+        sa.Index('ix_threads_removed_date', removed_date,
+                 postgresql_where=removed_date.isnot(None)),
+        sa.Index('ix_threads_subject_search', search_document(subject),
+                 postgresql_using='gin'),
     )
 
 
@@ -42,4 +56,54 @@ class Files(Base):
 
     __table_args__ = (
         sa.UniqueConstraint('board', 'md5', name='files_unique'),
+        # Keyset pagination order
+        sa.Index('ix_files_timestamp_id', 'timestamp', 'id'),
+        # Same order for lists filtered by board or thread
+        sa.Index('ix_files_board_timestamp_id',
+                 board, timestamp.desc(), id.desc()),
+        sa.Index('ix_files_thread_timestamp_id',
+                 thread, timestamp.desc(), id.desc()),
+        # Cleanup of files in removed threads
+        sa.Index('ix_files_thread_last_check', thread, last_check),
+        sa.Index('ix_files_name_search', search_document(name),
+                 postgresql_using='gin'),
+    )
+
+
+class Counts(Base):
+    """Files count for thread, kept up to date on ingest and cleanup."""
+    thread = sa.Column(
+        sa.ForeignKey('threads.id', onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True
+    )
+    board = sa.Column(sa.Text, index=True)
+    files = sa.Column(sa.Integer, nullable=False, default=0)
+
+
+class Clusters(Base):
+    """Newest file and number of reposts of every md5."""
+    md5 = sa.Column(sa.Text, primary_key=True)
+    file = sa.Column(
+        sa.ForeignKey('files.id', onupdate="CASCADE", ondelete="CASCADE"),
+        unique=True, nullable=False
+    )
+    reposts = sa.Column(sa.Integer, nullable=False, default=1)
+
+
+class DataVersion(Base):
+    """Single row with version of data, bumped by every write."""
+    __tablename__ = 'data_version'
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    # Creation time tells versions of recreated database apart
+    epoch = sa.Column(
+        sa.BigInteger, nullable=False,
+        server_default=sa.text('extract(epoch from now())::bigint')
     )
+    version = sa.Column(sa.BigInteger, nullable=False, default=0)
+
+
+class SchemaMigrations(Base):
+    """Schema changes applied to database."""
+    __tablename__ = 'schema_migrations'
+    name = sa.Column(sa.Text, primary_key=True)
+    applied = sa.Column(sa.DateTime(timezone=True), default=sa.func.now())
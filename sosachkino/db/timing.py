@@ -0,0 +1,86 @@
+import time
+import asyncio
+import logging
+import aiopg
+import psycopg2
+import sqlalchemy as sa
+
+from sosachkino import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TimedConnection:
+    """Connection wrapper measuring queries of single DB method."""
+    def __init__(self, conn, method, db):
+        self.conn = conn
+        self.method = method
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    async def execute(self, query, *multiparams, **params):
+        """Execute query and record its duration."""
+        start = time.perf_counter()
+        try:
+            result = await self.conn.execute(query, *multiparams, **params)
+        except asyncio.CancelledError:
+            # aiopg reports statement timeout as cancellation, real
+            # cancellation closes connection while timeout doesn't
+            if self.conn.closed:
+                raise
+            raise psycopg2.extensions.QueryCanceledError(
+                'Statement timeout in {}'.format(self.method)
+            )
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.DB_QUERY.labels(self.method).observe(elapsed)
+        if self.db.slow_query and elapsed >= self.db.slow_query:
+            await self.report(query, elapsed)
+        return result
+
+    async def scalar(self, query, *multiparams, **params):
+        """Execute query and get first column of first row."""
+        result = await self.execute(query, *multiparams, **params)
+        return await result.scalar()
+
+    async def report(self, query, elapsed):
+        """Log slow query, optionally with its plan."""
+        if isinstance(query, str):
+            sql, params = query, None
+        else:
+            compiled = query.compile(dialect=self.db.engine.dialect)
+            sql, params = str(compiled), compiled.params
+        logger.warning('Slow query in %s: %.3f s\n%s\nparams: %s',
+                       self.method, elapsed, sql, params)
+        # Analyze executes query again, so only reads are explained
+        if not self.db.explain_slow or not isinstance(query, sa.sql.Select):
+            return
+        # Statement is explained once per interval and never in the
+        # request path, it would make slow request twice slower
+        if (self.db.explain_tasks or
+                self.db.explained.get(sql) is not None):
+            return
+        self.db.explained.set(sql, True)
+        task = asyncio.ensure_future(explain(self.db, self.method,
+                                             sql, params))
+        self.db.explain_tasks.add(task)
+        task.add_done_callback(self.db.explain_tasks.discard)
+
+
+async def explain(db, method, sql, params):
+    """Log plan of slow query."""
+    try:
+        # Separate connection, pools are left for real work
+        async with aiopg.connect(**db.db_config) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql,
+                                  params)
+                plan = [row[0] for row in await cur.fetchall()]
+        logger.warning('Plan of slow query in %s:\n%s',
+                       method, '\n'.join(plan))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("Couldn't explain slow query in %s: %s", method, e)
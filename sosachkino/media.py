@@ -0,0 +1,233 @@
+import os
+import re
+import asyncio
+import logging
+import functools
+import pathlib
+from collections import OrderedDict
+from aiohttp import web
+
+from sosachkino import metrics
+from sosachkino.api import ApiError, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """Disk cache of sosach files with LRU eviction by total size.
+
+    Files are stored under their sosach paths and never change, so
+    cached copy is always valid.
+    """
+    # Only files of boards are proxied
+    path_re = re.compile(
+        r'^\w+/(src|thumb)/\d+/\w+\.(webm|mp4|jpe?g|png|gif)$', re.I
+    )
+    video_extensions = ('.webm', '.mp4')
+
+    def __init__(self, api, directory, max_size, concurrency=4,
+                 rate=10, burst=20):
+        self.api = api
+        # Downloads for users don't wait behind updater requests, but
+        # page views still can't flood 2ch
+        self.limiter = RateLimiter(rate, burst)
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.size = 0
+        # Relative path to size, least recently used first
+        self.files = OrderedDict()
+        # Downloads in progress, concurrent misses wait for them
+        self.pending = {}
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def scan(self):
+        """Get cached files from disk, oldest first."""
+        files = []
+        for path in self.directory.rglob('*'):
+            if not path.is_file():
+                continue
+            if path.name.endswith('.part'):
+                # Left by interrupted download
+                path.unlink()
+                continue
+            stat = path.stat()
+            files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        return [(p.relative_to(self.directory).as_posix(), size)
+                for mtime, p, size in files]
+
+    async def run(self, func, *args):
+        """Run blocking filesystem call in executor."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def init(self, app):
+        """Load cache state from disk."""
+        await self.run(functools.partial(
+            self.directory.mkdir, parents=True, exist_ok=True
+        ))
+        for path, size in await self.run(self.scan):
+            self.files[path] = size
+            self.size += size
+        await self.evict()
+        logger.info('Media cache has %s files, %s bytes',
+                    len(self.files), self.size)
+
+    async def close(self, app):
+        """Stop background downloads."""
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def local_path(self, path):
+        """Get cache file path."""
+        return self.directory / path
+
+    async def add(self, path, size):
+        """Account new cached file."""
+        self.size += size - self.files.pop(path, 0)
+        self.files[path] = size
+        await self.evict()
+
+    @staticmethod
+    def unlink(paths):
+        """Remove files, missing ones are skipped."""
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def evict(self):
+        """Remove least recently used files over size limit."""
+        removed = []
+        # The newest file is kept even if it alone is too big
+        while self.size > self.max_size and len(self.files) > 1:
+            path, size = self.files.popitem(last=False)
+            self.size -= size
+            removed.append(self.local_path(path))
+        metrics.MEDIA_CACHE.labels('bytes').set(self.size)
+        metrics.MEDIA_CACHE.labels('files').set(len(self.files))
+        if removed:
+            await self.run(self.unlink, removed)
+
+    async def cached(self, path):
+        """Get cached file path or None."""
+        local = self.local_path(path)
+        try:
+            size = (await self.run(local.stat)).st_size
+        except FileNotFoundError:
+            # Evicted by other process
+            self.size -= self.files.pop(path, 0)
+            return None
+        if path in self.files:
+            self.files.move_to_end(path)
+        else:
+            # Other processes share directory
+            await self.add(path, size)
+        return local
+
+    async def download(self, path, background):
+        """Download file to cache, get its path or None if missing."""
+        local = self.local_path(path)
+        await self.run(functools.partial(
+            local.parent.mkdir, parents=True, exist_ok=True
+        ))
+        part = local.with_name('{}.{}.part'.format(local.name, os.getpid()))
+        # Background downloads share rate limit with updater
+        limiter = self.api.limiter if background else self.limiter
+        try:
+            async with self.semaphore:
+                size = await self.api.download('/' + path, part, limiter)
+            if size is None:
+                return None
+            await self.run(os.replace, part, local)
+        finally:
+            await self.run(self.unlink, [part])
+        await self.add(path, size)
+        return local
+
+    def done(self, path, task):
+        """Forget finished download."""
+        self.pending.pop(path, None)
+        # Waiters may be gone, error must be retrieved anyway
+        if not task.cancelled():
+            task.exception()
+
+    async def fetch(self, path, background=False):
+        """Get file into cache, misses of the same file are coalesced."""
+        task = self.pending.get(path)
+        if task is None:
+            task = asyncio.ensure_future(self.download(path, background))
+            self.pending[path] = task
+            task.add_done_callback(lambda t: self.done(path, t))
+        # Client going away doesn't stop download for others
+        return await asyncio.shield(task)
+
+    async def prefetch(self, paths, background=True):
+        """Download files that aren't cached yet, errors are logged.
+
+        Background prefetch shares rate limit with updater, downloads
+        started by users have their own one.
+        """
+        for path in paths:
+            path = path.lstrip('/')
+            if not self.path_re.match(path) or await self.cached(path):
+                continue
+            try:
+                await self.fetch(path, background)
+            except ApiError as e:
+                logger.warning("Couldn't prefetch %s: %s", path, e)
+
+    def prefetch_later(self, paths, background=True):
+        """Start prefetch without waiting for it."""
+        task = asyncio.ensure_future(self.prefetch(paths, background))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def is_video(self, path):
+        """Check if path is video, they are too big to wait for."""
+        return path.lower().endswith(self.video_extensions)
+
+    async def handler(self, request):
+        """Serve file from cache, download it on miss."""
+        path = request.match_info['path']
+        if not self.path_re.match(path):
+            raise web.HTTPNotFound()
+        local = await self.cached(path)
+        if local is None:
+            if self.is_video(path):
+                # Client gets original while cache is filled
+                metrics.MEDIA_REQUESTS.labels('redirect').inc()
+                self.prefetch_later([path], background=False)
+                raise web.HTTPFound(self.api.file_url('/' + path))
+            try:
+                local = await self.fetch(path)
+            except ApiError:
+                metrics.MEDIA_REQUESTS.labels('error').inc()
+                raise web.HTTPBadGateway()
+            if local is None:
+                metrics.MEDIA_REQUESTS.labels('missing').inc()
+                raise web.HTTPNotFound()
+            metrics.MEDIA_REQUESTS.labels('miss').inc()
+        else:
+            metrics.MEDIA_REQUESTS.labels('hit').inc()
+        # FileResponse handles Range and conditional requests
+        return web.FileResponse(local, headers={
+            'Cache-Control': 'public, max-age=604800, immutable'
+        })
+
+
+def create_media(config, api):
+    """Create media cache from config, None if it is disabled."""
+    if not config.getboolean('media', 'enabled', fallback=False):
+        return None
+    return MediaCache(
+        api,
+        config.get('media', 'directory', fallback='media'),
+        config.getint('media', 'max_size', fallback=1024) * 1024 * 1024,
+        concurrency=config.getint('media', 'concurrency', fallback=4),
+        rate=config.getfloat('media', 'rate', fallback=10),
+        burst=config.getint('media', 'burst', fallback=20)
+    )
@@ -0,0 +1,188 @@
+import os
+import time
+import pathlib
+import contextlib
+from aiohttp import web
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+enabled = prometheus_client is not None
+# Several web processes share metrics through files in this directory,
+# it must be set before start, values are created at import
+multiprocess_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+class NoMetric:
+    """Metric stub used when prometheus_client isn't installed."""
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def histogram(name, documentation, labels):
+    if not enabled:
+        return NoMetric()
+    return prometheus_client.Histogram(name, documentation, labels)
+
+
+def counter(name, documentation, labels):
+    if not enabled:
+        return NoMetric()
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def gauge(name, documentation, labels, mode='livesum'):
+    """Create gauge, mode tells how values of processes are merged."""
+    if not enabled:
+        return NoMetric()
+    return prometheus_client.Gauge(name, documentation, labels,
+                                   multiprocess_mode=mode)
+
+
+REQUEST_LATENCY = histogram(
+    'sosachkino_http_request_duration_seconds',
+    'Web request latency by route',
+    ['route', 'method', 'status']
+)
+API_LATENCY = histogram(
+    'sosachkino_api_request_duration_seconds',
+    'Sosach API request latency by endpoint',
+    ['endpoint']
+)
+API_ERRORS = counter(
+    'sosachkino_api_errors_total',
+    'Failed sosach API requests by endpoint',
+    ['endpoint']
+)
+BOARD_UPDATE_DURATION = histogram(
+    'sosachkino_updater_board_duration_seconds',
+    'Duration of board update run',
+    ['board']
+)
+THREADS = counter(
+    'sosachkino_updater_threads_total',
+    'Threads seen by updater by result (fetched, skipped, failed)',
+    ['board', 'result']
+)
+FILES_INGESTED = counter(
+    'sosachkino_updater_files_total',
+    'Videos saved by updater',
+    ['board']
+)
+CLEANUP_CHECKS = counter(
+    'sosachkino_cleanup_checks_total',
+    'Files checked by cleanup by result (exists, missing, error)',
+    ['result']
+)
+MEDIA_REQUESTS = counter(
+    'sosachkino_media_requests_total',
+    'Media proxy requests by result (hit, miss, redirect, missing, error)',
+    ['result']
+)
+MEDIA_CACHE = gauge(
+    'sosachkino_media_cache',
+    'Media disk cache state (bytes, files)',
+    ['state'],
+    # Processes share cache directory
+    mode='livemax'
+)
+DB_WAIT = histogram(
+    'sosachkino_db_acquire_duration_seconds',
+    'Time spent waiting for pool connection by DB method',
+    ['method']
+)
+DB_QUERY = histogram(
+    'sosachkino_db_query_duration_seconds',
+    'Query execution time by DB method',
+    ['method']
+)
+DB_ACQUIRE_TIMEOUTS = counter(
+    'sosachkino_db_acquire_timeouts_total',
+    'Failed attempts to get connection from pool',
+    ['pool']
+)
+DB_POOL = gauge(
+    'sosachkino_db_pool_connections',
+    'Database pool connections by state (size, free, used, max, waiting)',
+    ['pool', 'state']
+)
+
+
+@contextlib.contextmanager
+def timer(metric, *labels):
+    """Observe duration of block in histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.labels(*labels).observe(time.perf_counter() - start)
+
+
+@web.middleware
+async def middleware(request, handler):
+    """Measure latency of every web request."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.name or 'unnamed'
+        REQUEST_LATENCY.labels(route, request.method, status).observe(
+            time.perf_counter() - start
+        )
+
+
+def update_pools(db):
+    """Set database pool gauges from engines state."""
+    for pool, engine in db.pools.items():
+        DB_POOL.labels(pool, 'size').set(engine.size)
+        DB_POOL.labels(pool, 'free').set(engine.freesize)
+        DB_POOL.labels(pool, 'used').set(engine.size - engine.freesize)
+        DB_POOL.labels(pool, 'max').set(engine.maxsize)
+        DB_POOL.labels(pool, 'waiting').set(db.waiting[pool])
+
+
+def clear_processes():
+    """Remove metrics files left by previous run."""
+    if not enabled or not multiprocess_dir:
+        return
+    for path in pathlib.Path(multiprocess_dir).glob('*.db'):
+        path.unlink()
+
+
+def process_dead(pid):
+    """Drop live gauges of exited process."""
+    if enabled and multiprocess_dir:
+        multiprocess.mark_process_dead(pid)
+
+
+async def handler(request):
+    """Expose metrics in Prometheus text format."""
+    update_pools(request.app['db'])
+    registry = prometheus_client.REGISTRY
+    if multiprocess_dir:
+        # Sum of all processes, not only the one answering
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return web.Response(
+        body=prometheus_client.generate_latest(registry),
+        headers={'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+    )
@@ -0,0 +1,79 @@
+import os
+import time
+import signal
+import socket
+import logging
+from aiohttp import web
+
+from sosachkino import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def start_worker(create_app, config, sock):
+    """Fork web server process serving on shared socket."""
+    pid = os.fork()
+    if pid:
+        return pid
+    # Child process, aiohttp installs its own graceful handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        logger.info('Worker %s started', os.getpid())
+        web.run_app(create_app(config), sock=sock, print=None)
+    except Exception as e:
+        logger.exception('Worker %s failed: %s', os.getpid(), e)
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def run_workers(create_app, config, host, port, workers):
+    """Serve app from several processes, restart crashed ones.
+
+    Socket is bound before forking and shared by all processes, only
+    one of them runs updater because of updater lock.
+    """
+    if metrics.enabled and not metrics.multiprocess_dir:
+        logger.warning('PROMETHEUS_MULTIPROC_DIR is not set, every '
+                       'process has its own metrics')
+    metrics.clear_processes()
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    children = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info('Stopping workers')
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        children.add(start_worker(create_app, config, sock))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        metrics.process_dead(pid)
+        if stopping:
+            continue
+        logger.error('Worker %s exited with status %s, restarting',
+                     pid, status)
+        # Don't restart in tight loop when something is broken
+        time.sleep(1)
+        if not stopping:
+            children.add(start_worker(create_app, config, sock))
+    sock.close()
+    logger.info('All workers stopped')
@@ -80,8 +80,78 @@ var filterThreads = function (query) {
 };
 
 var threadInput = byId('thread-input');
+
+// Add thread found on server to sidebar
+var addThread = function (thread) {
+    if (byId('thread-' + thread.id))
+        return;
+    var subject = thread.subject || '';
+    var check = document.createElement('div');
+    check.className = 'form-check';
+    check.dataset.search = ''.concat(
+        '/', thread.board, '/', thread.id, ' ', subject).toLowerCase();
+
+    var input = document.createElement('input');
+    input.className = 'form-check-input';
+    input.type = 'checkbox';
+    input.name = 'thread';
+    input.value = thread.id;
+    input.id = 'thread-' + thread.id;
+
+    var label = document.createElement('label');
+    label.className = 'form-check-label';
+    label.htmlFor = input.id;
+    var small = document.createElement('small');
+    small.appendChild(document.createTextNode(
+        ''.concat('/', thread.board, '/', thread.id, ' ')));
+    var badge = document.createElement('span');
+    badge.className = 'badge badge-secondary';
+    badge.textContent = thread.files;
+    small.appendChild(badge);
+    small.appendChild(document.createElement('br'));
+    var text = document.createElement('span');
+    text.textContent = subject;
+    small.appendChild(text);
+    label.appendChild(small);
+
+    check.appendChild(input);
+    check.appendChild(label);
+    document.querySelector('#thread-filter > div').appendChild(check);
+};
+
+// Sidebar has only most active threads, others are found on server
+var threadTimer = null;
+var findThreads = function (query) {
+    clearTimeout(threadTimer);
+    if (query.length < 2)
+        return;
+    threadTimer = setTimeout(function () {
+        var params = new URLSearchParams({prefix: query});
+        var boards = document.querySelectorAll('#boards-filter input:checked');
+        for (var i = 0; i < boards.length; i++) {
+            params.append('board', boards[i].value);
+        }
+        fetch(threadInput.dataset.url + '?' + params.toString())
+            .then(function (response) { return response.json(); })
+            .then(function (threads) {
+                // Input was changed while waiting
+                if (threadInput.value.toLowerCase() !== query)
+                    return;
+                for (var i = 0; i < threads.length; i++) {
+                    addThread(threads[i]);
+                }
+                filterThreads(query);
+            })
+            .catch(function (e) {
+                console.log(e);
+            });
+    }, 300);
+};
+
 threadInput.addEventListener('input', function (e) {
-    filterThreads(e.target.value.toLowerCase());
+    var query = e.target.value.toLowerCase();
+    filterThreads(query);
+    findThreads(query);
 });
 
 var resetBtn = byId('reset-thread');
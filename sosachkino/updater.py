@@ -3,131 +3,276 @@ import asyncio
 import datetime
 import time
 
+from sosachkino import metrics
 from sosachkino.api import ApiError
 
 
 logger = logging.getLogger(__name__)
 
 
+class BoardStats:
+    """Schedule and statistics of single board updates."""
+    def __init__(self, board, interval):
+        self.board = board
+        self.interval = interval
+        self.runs = 0
+        self.errors = 0
+        self.videos = 0
+        # Smoothed new videos per second
+        self.rate = None
+        self.last_videos = None
+        self.last_run = None
+        self.last_duration = None
+        self.next_run = None
+
+    def as_dict(self):
+        """Get JSON-serializable stats."""
+        return {
+            'board': self.board,
+            'interval': self.interval,
+            'runs': self.runs,
+            'errors': self.errors,
+            'videos': self.videos,
+            'rate': self.rate,
+            'last_videos': self.last_videos,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'next_run': self.next_run,
+        }
+
+
 class Updater:
     """Object that checks for new videos and updates database."""
-    is_running = False
     last_check = None
     is_running_cleanup = False
     last_check_cleanup = None
     extensions = ('.webm', '.mp4')
 
-    def __init__(self, config, api, db):
+    def __init__(self, config, api, db, media=None):
         self.db = db
         self.config = config
         self.api = api
+        # Thumbnails of new videos are downloaded to media cache
+        self.prefetch = None
+        if media is not None and config.getboolean(
+                'media', 'prefetch', fallback=False
+        ):
+            self.prefetch = media
+        # Threads that failed in last run of every board
+        self.failed = {}
+        # Boards being updated right now
+        self.running = set()
+        self.stats = {}
+        # Holds updater lock, only one process does
+        self.active = False
+
+    @property
+    def is_running(self):
+        """Check if any board is being updated."""
+        return bool(self.running)
+
+    def get_boards(self):
+        """Get list of boards from config."""
+        return [b.strip() for b in
+                self.config['updater']['boards'].split(',')]
 
     async def update(self, boards=None):
         """Check for new webms."""
-        self.is_running = True
         if boards is None:
-            boards = [b.strip() for b in
-                      self.config['updater']['boards'].split(',')]
-        for board in boards:
-            await self.update_board(board)
+            boards = self.get_boards()
+        # Boards share api rate limit, so they can be processed together
+        await asyncio.gather(*[self.update_board(b) for b in boards])
         self.last_check = time.time() # Maybe asyncio.loop.time()?
-        self.is_running = False
 
     async def update_board(self, board):
-        """Get list of threads and process every thread."""
+        """Check board for new webms, get number of saved videos.
+
+        None is returned when board couldn't be updated.
+        """
+        if board in self.running:
+            logger.info('Board /%s/ is already updating, skipping', board)
+            return None
+        self.running.add(board)
+        try:
+            with metrics.timer(metrics.BOARD_UPDATE_DURATION, board):
+                return await self.process_board(board)
+        except (Exception, asyncio.CancelledError):
+            # Interrupted run leaves unknown state, next run gets whole
+            # catalog and checks every thread in it
+            self.failed.pop(board, None)
+            self.api.forget_catalog(board)
+            raise
+        finally:
+            self.running.discard(board)
+
+    async def process_board(self, board):
+        """Get list of threads and process changed threads concurrently."""
         logger.info('Updating board /%s/', board)
+        started = time.monotonic()
+        previous = self.api.cached_catalog(board)
         try:
             threads = await self.api.get_catalog(board)
         except ApiError as e:
             logger.warning("Couldn't get /%s/ catalog: %s", board, e)
-            return
+            return None
         except Exception as e:
             logger.exception("Error while getting catalog: %s", e)
-            return
+            return None
+        # Unknown until this run finishes
+        failed = self.failed.pop(board, None)
+        if threads is None:
+            if failed is not None and not failed:
+                logger.info('Catalog of /%s/ not modified, skipping', board)
+                self.failed[board] = failed
+                return 0
+            threads = previous
         thread_ids = [int(thread['num']) for thread in threads]
-        state = await self.db.get_state(board, thread_ids)
-        interval = int(self.config['updater']['sleep'])
-        await asyncio.sleep(interval)
-        for thread in threads:
-            thread_id = int(thread['num'])
 
+        # Only threads differing from last catalog can have new posts,
+        # plus ones which weren't saved last time
+        candidates = threads
+        if previous is not None and failed is not None:
+            old = {thread['num']: thread for thread in previous}
+            candidates = [thread for thread in threads
+                          if old.get(thread['num']) != thread or
+                          thread['num'] in failed]
+        state = {}
+        if len(candidates):
+            state = await self.db.get_state(
+                board, [int(thread['num']) for thread in candidates]
+            )
+
+        changed = []
+        for thread in candidates:
             # Check if thread must be skipped
             is_changed = self.is_changed(state, thread)
             is_ignored = self.is_ignored(state, thread) # FIXME
             if not is_changed or is_ignored:
                 logger.debug(
                     "Skipping thread /%s/%s, changed: %s, ignored: %s",
-                    board, thread_id, is_changed, is_ignored
+                    board, thread['num'], is_changed, is_ignored
                 )
                 continue
+            changed.append(thread)
 
-            logger.debug('Processing thread /%s/%s', board, thread['num'])
-            # Get last checked post
-            from_id = None
-            if thread_id in state:
-                from_id = state[thread_id]['last']
-            # FIXME process this
-            try:
-                data = await self.api.get_thread(board, thread_id, from_id)
-            except ApiError as e:
-                logger.warning("Couldn't get thread /%s/%s : %s",
-                               board, thread_id, e)
-                continue
-            except Exception as e:
-                logger.exception("Error while processing thread /%s/%s: %s",
-                                 board, thread_id, e)
-                continue
+        # Most active threads go first, so they aren't waiting for
+        # the whole board when run has deadline
+        queue = asyncio.PriorityQueue()
+        for i, thread in enumerate(changed):
+            queue.put_nowait((self.priority(state, thread), i, thread))
+        deadline = float(self.config['updater'].get('deadline', 0))
+        end = started + deadline if deadline else None
+        failed = set()
+        saved = []
 
-            # Check API error, maybe move to api later FIXME
-            if isinstance(data, dict):
-                if 'Error' in data and 'Code' in data:
-                    logger.warning("Response error /%s/%s : %s",
-                                   board, thread_id, data)
-                    continue
-
-            # Process posts
-            files = []
-            try:
-                last_id = thread_id
-                for post in data:
-                    for f in post['files']:
-                        if not self.is_video(f['path']):
-                            continue
-                        f.update({
-                            'thread': int(thread['num']),
-                            'board': board,
-                            'timestamp': int(post['timestamp'])
-                        })
-                        files.append(f)
-                    last_id = int(post['num'])
-
-                await self.db.update_thread_state(board, thread, last_id)
-                if len(files):
-                    logger.info('Saving %s new videos for /%s/',
-                                len(files), board)
-                    await self.db.save_videos(files)
-                    files = []
-            except Exception as e:
-                logger.exception("Error while processing posts /%s/%s: %s",
-                                 board, thread_id, e)
-                continue
+        # Requests are throttled by api rate limiter, number of workers
+        # only caps number of threads processed at the same time
+        async def worker():
+            while not queue.empty():
+                if end is not None and time.monotonic() > end:
+                    return
+                thread = queue.get_nowait()[2]
+                result = await self.process_thread(board, thread, state)
+                if result is None:
+                    failed.add(thread['num'])
+                else:
+                    saved.append(result)
 
-            # Sleep for configured time
-            await asyncio.sleep(interval)
+        concurrency = int(self.config['updater'].get('concurrency', 4))
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+        # Threads that missed deadline are processed next time
+        if not queue.empty():
+            logger.info('Deadline passed for /%s/, %s threads left',
+                        board, queue.qsize())
+            while not queue.empty():
+                failed.add(queue.get_nowait()[2]['num'])
+        self.failed[board] = failed
+        metrics.THREADS.labels(board, 'fetched').inc(len(saved))
+        metrics.THREADS.labels(board, 'failed').inc(len(failed))
+        metrics.THREADS.labels(board, 'skipped').inc(
+            len(threads) - len(changed)
+        )
+        metrics.FILES_INGESTED.labels(board).inc(sum(saved))
         await self.db.set_removed(board, thread_ids)
         await self.db.clean_threads()
+        return sum(saved)
+
+    async def process_thread(self, board, thread, state):
+        """Get new posts from thread and save found videos.
+
+        Returns number of saved videos or None if thread must be
+        processed again.
+        """
+        thread_id = int(thread['num'])
+        logger.debug('Processing thread /%s/%s', board, thread_id)
+        # Get last checked post
+        from_id = None
+        if thread_id in state:
+            from_id = state[thread_id]['last']
+        # Process posts while thread is being downloaded
+        files = []
+        try:
+            last_id = thread_id
+            async for post in self.api.iter_thread(
+                    board, thread_id, from_id,
+                    file_filter=lambda f: self.is_video(f['path'])
+            ):
+                for f in post['files']:
+                    f.update({
+                        'thread': thread_id,
+                        'board': board,
+                        'timestamp': int(post['timestamp'])
+                    })
+                    files.append(f)
+                last_id = int(post['num'])
+        except ApiError as e:
+            logger.warning("Couldn't get thread /%s/%s : %s",
+                           board, thread_id, e)
+            return None
+        except Exception as e:
+            logger.exception("Error while processing thread /%s/%s: %s",
+                             board, thread_id, e)
+            return None
+
+        try:
+            if len(files):
+                logger.info('Saving %s new videos for /%s/',
+                            len(files), board)
+            # Big batches (e.g. first run over old thread) go to staging
+            staging = len(files) >= int(
+                self.config['updater'].get('staging_threshold', 1000)
+            )
+            await self.db.save_thread(board, thread, last_id, files, staging)
+        except Exception as e:
+            logger.exception("Error while processing posts /%s/%s: %s",
+                             board, thread_id, e)
+            return None
+        if self.prefetch is not None and len(files):
+            self.prefetch.prefetch_later([f['thumbnail'] for f in files])
+        return len(files)
+
+    # Catalog fields that change when thread gets new posts
+    change_fields = ('files_count', 'posts_count', 'lasthit')
 
     def is_changed(self, state, thread):
         """Check if thread was changed from last update."""
         thread_id = int(thread['num'])
-        # TODO: something more interesting that files_count
-        if thread_id in state:
-            if state[thread_id]['files_count'] != thread['files_count']:
-                return True
-        else:
+        if thread_id not in state:
             return True
+        for field in self.change_fields:
+            if (field in thread and
+                    state[thread_id][field] != thread[field]):
+                return True
         return False
 
+    def priority(self, state, thread):
+        """Get queue priority of thread, lower is processed earlier."""
+        thread_id = int(thread['num'])
+        new_files = int(thread.get('files_count') or 0)
+        if thread_id in state:
+            new_files -= state[thread_id]['files_count'] or 0
+        return (-new_files, -int(thread.get('lasthit') or 0))
+
     def is_ignored(self, state, thread):
         """Check if thread is ignored and must be skipped."""
         thread_id = int(thread['num'])
@@ -135,15 +280,6 @@ class Updater:
         #     return state[thread_id]['hidden']
         return False
 
-    def needs_update(self):
-        """Check if check interval already passed since last check."""
-        if self.is_running:
-            return False
-        if self.last_check is None:
-            return True
-        return (time.time() - self.last_check >
-                int(self.config['updater']['interval']))
-
     def needs_cleanup(self):
         """Check if cleanup interval already passed since last run."""
         if self.is_running_cleanup:
@@ -156,56 +292,145 @@ class Updater:
     async def cleanup(self):
         """Check for removed webms."""
         self.is_running_cleanup = True
-        from_date = datetime.datetime.now() - datetime.timedelta(
-            seconds=int(self.config['cleanup']
-                        .get('removed_thread_check_time', 3600))
-        )
-        check_files = await self.db.get_removed_thread_check(from_date)
-        # If all threads are ok, just check some newer files
-        if not len(check_files):
+        try:
+            config = self.config['cleanup']
+            limit = int(config.get('limit', 600))
             from_date = datetime.datetime.now() - datetime.timedelta(
-                seconds=int(self.config['cleanup']
-                            .get('file_check_time', 14400))
+                seconds=int(config.get('removed_thread_check_time', 3600))
             )
-            check_files = await self.db.get_files_to_check(from_date)
-        logger.debug('Checking %s files', len(check_files))
-        interval = int(self.config['cleanup']['sleep'])
-        for f in check_files:
+            check_files = await self.db.get_removed_thread_check(
+                from_date, limit
+            )
+            # If all threads are ok, just check some newer files
+            if not len(check_files):
+                from_date = datetime.datetime.now() - datetime.timedelta(
+                    seconds=int(config.get('file_check_time', 14400))
+                )
+                check_files = await self.db.get_files_to_check(
+                    from_date, limit
+                )
+            logger.debug('Checking %s files', len(check_files))
+            batch_size = int(config.get('batch_size', 100))
+            semaphore = asyncio.Semaphore(int(config.get('concurrency', 8)))
+            for i in range(0, len(check_files), batch_size):
+                batch = check_files[i:i + batch_size]
+                results = await asyncio.gather(
+                    *[self.check_file(f, semaphore) for f in batch]
+                )
+                removed = [f['id'] for f, exists in zip(batch, results)
+                           if exists is False]
+                checked = [f['id'] for f, exists in zip(batch, results)
+                           if exists is True]
+                metrics.CLEANUP_CHECKS.labels('missing').inc(len(removed))
+                metrics.CLEANUP_CHECKS.labels('exists').inc(len(checked))
+                metrics.CLEANUP_CHECKS.labels('error').inc(
+                    len(batch) - len(removed) - len(checked)
+                )
+                try:
+                    await self.db.remove_files(removed)
+                    await self.db.update_checked(checked)
+                    # Cleand threads when there is no update
+                    if not self.is_running:
+                        await self.db.clean_threads()
+                except Exception as e:
+                    logger.exception("Error while saving check results: %s",
+                                     e)
+                logger.debug('Checked %s files, %s removed',
+                             len(batch), len(removed))
+            self.last_check_cleanup = time.time()
+        finally:
+            # Cancelled when updater lock is lost, may run again later
+            self.is_running_cleanup = False
+
+    async def check_file(self, f, semaphore):
+        """Check if file exists, None if it is unknown."""
+        async with semaphore:
             try:
-                exists = await self.api.check_file(f['path'])
-                if not exists:
-                    await self.db.remove_file(f['id'])
-                else:
-                    await self.db.update_checked(f['id'])
+                return await self.api.check_file(f['path'])
             except ApiError as e:
                 logger.warning("Couldn't check %s: %s", f['path'], e)
             except Exception as e:
-                logger.exception("Error while checking %s: %s", f['path'], e)
-            # Cleand threads when there is no update
-            if not self.is_running:
-                await self.db.clean_threads()
-            await asyncio.sleep(interval)
-        self.last_check_cleanup = time.time()
-        self.is_running_cleanup = False
+                logger.exception("Error while checking %s: %s",
+                                 f['path'], e)
+        return None
+
+    def reschedule(self, stats, videos, elapsed):
+        """Adapt board update interval to rate of new videos.
+
+        Interval is chosen so that every run gets about target_videos
+        new videos, elapsed is time since previous run in seconds.
+        """
+        config = self.config['updater']
+        min_interval = float(config.get('min_interval', 30))
+        max_interval = float(config.get('max_interval', 900))
+        target = float(config.get('target_videos', 20))
+        interval = stats.interval
+        if videos is None:
+            # Back off on errors
+            interval = stats.interval * 2
+        elif elapsed:
+            # First run has backlog of unknown age, it is skipped
+            rate = videos / elapsed
+            if stats.rate is None:
+                stats.rate = rate
+            else:
+                # Smoothed, so one busy run doesn't change much
+                stats.rate = (stats.rate + rate) / 2
+            if stats.rate > 0:
+                interval = target / stats.rate
+            else:
+                interval = stats.interval * 1.5
+        stats.interval = min(max(interval, min_interval), max_interval)
+
+    async def run_board(self, board):
+        """Run endless update loop of board with adaptive interval."""
+        stats = self.stats[board]
+        while True:
+            started = time.time()
+            try:
+                videos = await self.update_board(board)
+            except Exception as e:
+                logger.exception("Error on /%s/ update run: %s", board, e)
+                videos = None
+            # Videos of this run were posted since previous one
+            elapsed = None
+            if stats.last_run is not None:
+                elapsed = started - stats.last_run
+            stats.runs += 1
+            stats.last_run = started
+            stats.last_duration = time.time() - started
+            stats.last_videos = videos
+            if videos is None:
+                stats.errors += 1
+            else:
+                stats.videos += videos
+            self.reschedule(stats, videos, elapsed)
+            stats.next_run = time.time() + stats.interval
+            logger.info('Board /%s/: %s new videos, next run in %.0f s',
+                        board, videos, stats.interval)
+            self.last_check = time.time()
+            await asyncio.sleep(stats.interval)
+
+    def get_stats(self):
+        """Get scheduling stats of every board."""
+        return {board: stats.as_dict()
+                for board, stats in self.stats.items()}
 
     async def run_update(self, app):
-        """Run endless check loop."""
+        """Run update loops of every board."""
         try:
-            # Maybe call_later or more robust implementation of check
-            # will be better?
             if self.config['updater'].getboolean(
                     'disable', fallback=False
             ):
                 logger.info('Updater is disabled in config')
                 return
-            while True:
-                if self.needs_update():
-                    logger.info('Starting periodic update run')
-                    await self.update()
-                    logger.info('Finished periodic update run')
-                else:
-                    logger.info('Skipping update run')
-                await asyncio.sleep(int(self.config['updater']['interval']))
+            interval = float(self.config['updater']['interval'])
+            boards = self.get_boards()
+            for board in boards:
+                self.stats[board] = BoardStats(board, interval)
+            # Every board runs on its own timer, so slow board doesn't
+            # delay others
+            await asyncio.gather(*[self.run_board(b) for b in boards])
         except asyncio.CancelledError:
             pass
         except Exception as e:
@@ -234,23 +459,68 @@ class Updater:
         except Exception as e:
             logger.exception("Error on cleanup run: %s", e)
 
+    async def wait_lock(self, retry):
+        """Wait until this process can become active updater."""
+        while True:
+            try:
+                lock = await self.db.lock_updater()
+                if lock is not None:
+                    logger.info('Got updater lock')
+                    return lock
+                logger.info('Updater is active in other process')
+            except Exception as e:
+                logger.warning("Couldn't get updater lock: %s", e)
+            await asyncio.sleep(retry)
+
+    async def watch_lock(self, lock, interval):
+        """Wait until connection holding updater lock is lost."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with lock.cursor() as cur:
+                    await cur.execute('SELECT 1')
+            except Exception as e:
+                logger.error('Lost updater lock: %s', e)
+                return
+
+    async def run(self, app):
+        """Run updates and cleanup while holding updater lock."""
+        retry = int(self.config['updater'].get('lock_retry', 60))
+        try:
+            while True:
+                lock = await self.wait_lock(retry)
+                self.active = True
+                work = asyncio.gather(self.run_update(app),
+                                      self.run_cleanup(app))
+                watch = asyncio.ensure_future(self.watch_lock(lock, retry))
+                try:
+                    await asyncio.wait([work, watch],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    finished = work.done()
+                    watch.cancel()
+                    work.cancel()
+                    await asyncio.gather(work, watch, return_exceptions=True)
+                    await lock.close()
+                    self.active = False
+                # Everything is disabled, nothing to wait for
+                if finished:
+                    return
+        except asyncio.CancelledError:
+            pass
+
     @classmethod
     async def start_task(cls, app):
         """Start background tasks."""
-        app['check_task'] = app.loop.create_task(
-            app['updater'].run_update(app)
-        )
-        app['cleanup_task'] = app.loop.create_task(
-            app['updater'].run_cleanup(app)
+        app['updater_task'] = asyncio.ensure_future(
+            app['updater'].run(app)
         )
 
     @classmethod
     async def cleanup_task(cls, app):
         """Stop background tasks."""
-        app['check_task'].cancel()
-        app['cleanup_task'].cancel()
-        await app['check_task']
-        await app['cleanup_task']
+        app['updater_task'].cancel()
+        await app['updater_task']
 
     def is_video(self, path):
         """Check if file is supported video format."""
@@ -1,63 +1,89 @@
 import os
-import datetime
 import pytz
 from urllib.parse import urljoin
 
 from sosachkino.api import Api
 
 
+TIMEZONE = pytz.timezone('Europe/Moscow')
+
+
 class Video:
-    """Wrapper around video database row."""
+    """Video row with precomputed fields used by templates and API."""
+    __slots__ = ('id', 'name', 'board', 'thread', 'subject', 'url',
+                 'thumbnail', 'type', 'timestamp', 'date', 'size',
+                 'width', 'height', 'md5', 'reposts')
     types = {
         'webm': 'video/webm',
         'mp4': 'video/mp4'
     }
 
-    def __init__(self, data):
-        self.data = data
-        self.tz = pytz.timezone('Europe/Moscow') # Maybe make it class attr?
-
-    @property
-    def url(self):
-        """Get full video URL."""
-        return urljoin(Api.base_url, self.data['path'])
-
-    @property
-    def thumbnail(self):
-        """Get full thumbnail URL."""
-        return urljoin(Api.base_url, self.data['thumbnail'])
+    def __init__(self, data, base_url=Api.base_url):
+        self.id = data['id']
+        self.name = data['name']
+        self.board = data['board']
+        self.thread = data['thread']
+        self.subject = data['subject']
+        self.timestamp = data['timestamp']
+        self.size = data['size']
+        self.width = data['width']
+        self.height = data['height']
+        self.md5 = data['md5']
+        # Only known when reposts are collapsed
+        self.reposts = data.get('reposts')
+        self.url = self.get_url(base_url, data['path'])
+        self.thumbnail = self.get_url(base_url, data['thumbnail'])
+        self.type = self.get_type(data['path'])
+        self.date = self.timestamp.astimezone(TIMEZONE)
 
-    @property
-    def date(self):
-        """Get datetime from internal file timestamp."""
-        return self.data['timestamp'].astimezone(self.tz)
+    @classmethod
+    def from_rows(cls, rows, base_url=Api.base_url):
+        """Wrap all rows of page at once."""
+        return [cls(row, base_url) for row in rows]
 
-    def __getitem__(self, key):
-        """Get field from internal row."""
-        return self.data[key]
+    @staticmethod
+    def get_url(base_url, path):
+        """Get full URL for file path."""
+        if path and path.startswith('/'):
+            # Same as urljoin for site-relative paths, but much cheaper
+            return base_url.rstrip('/') + path
+        return urljoin(base_url, path)
 
-    @property
-    def type(self):
+    @classmethod
+    def get_type(cls, path):
         """Get video mime type by path."""
-        spl = os.path.splitext(self.data['path'])
-        if not len(spl) == 2:
-            return None
+        ext = os.path.splitext(path)[1]
         # Without leading dot
-        return self.types.get(spl[1][1:], None)
-
-    @property
-    def board(self):
-        """Get board."""
-        return '/{}/'.format(self.data['board'])
-    
-    @property
-    def thread(self):
-        """Get thread with board."""
-        return '/{}/{}'.format(self.data['board'], self.data['thread'])
+        return cls.types.get(ext[1:], None)
+
+    def __getitem__(self, key):
+        """Get field by name."""
+        return getattr(self, key)
 
     def thread_link(self, app, query=None):
         """Get link filtered by thread."""
-        q = dict(thread=self.data['thread'])
+        q = dict(thread=self.thread)
         if query is not None and 'limit' in query:
             q['limit'] = query['limit']
         return app.router['videos'].url_for().with_query(q)
+
+    def as_dict(self):
+        """Get JSON-serializable video data."""
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'board': self.board,
+            'thread': self.thread,
+            'subject': self.subject,
+            'url': self.url,
+            'thumbnail': self.thumbnail,
+            'type': self.type,
+            'size': self.size,
+            'width': self.width,
+            'height': self.height,
+            'md5': self.md5,
+            'timestamp': self.date.isoformat(),
+        }
+        if self.reposts is not None:
+            data['reposts'] = self.reposts
+        return data
@@ -1,4 +1,30 @@
 import math
+import base64
+import binascii
+import datetime
+
+from sosachkino.api import Api
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_cursor(timestamp, id_):
+    """Get opaque pagination token for (timestamp, id) position."""
+    micro = (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+    value = '{}:{}'.format(micro, id_).encode()
+    return base64.urlsafe_b64encode(value).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Get (timestamp, id) position from token, None if it is invalid."""
+    try:
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        micro, id_ = value.decode().split(':')
+        timestamp = EPOCH + datetime.timedelta(microseconds=int(micro))
+        return timestamp, int(id_)
+    except (ValueError, TypeError, OverflowError, binascii.Error):
+        return None
 
 
 def page_range(page, size):
@@ -34,47 +60,105 @@ class BaseView:
     """Base class for all views."""
     def __init__(self, app):
         self.app = app
+        # Files are linked through media proxy when it is enabled
+        self.base_url = app.get('media_url', Api.base_url)
+
+    def get_int_param(self, query, name, default):
+        """Get integer parameter from query with fallback value."""
+        value = default
+        try:
+            value = int(query.get(name))
+        except (TypeError, ValueError) as e:
+            pass
+        return value
+
+    def get_validators(self, db):
+        """Get conditional request headers for current data version."""
+        # No Last-Modified, seconds are too coarse for updates and
+        # only data version is the same in every process
+        return {
+            'ETag': '"{}"'.format(db.version),
+            # Always revalidate, unchanged data costs only 304
+            'Cache-Control': 'no-cache',
+        }
+
+    def is_not_modified(self, request, db):
+        """Check if client already has current data version."""
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is None:
+            return False
+        etag = '"{}"'.format(db.version)
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def get_filter(self, query):
+        """Get video filter from request query."""
+        q = dict()
+        if 'board' in query:
+            q['board'] = query.getall('board')
+        if 'thread' in query:
+            q['thread'] = query.getall('thread')
+        search = query.get('q', '').strip()
+        if search:
+            q['q'] = search
+        if query.get('unique') in ('1', 'on', 'true'):
+            q['unique'] = True
+        return q
 
     def get_pagination(self, route, page, count,
-                       page_size, query=None, kw=None):
-        """Get list of paginated links."""
+                       page_size, query=None, kw=None, cursors=None):
+        """Get list of paginated links.
+
+        When cursors dict is passed, its prev and next tokens are used
+        for prev/next links instead of page numbers. Page may be None
+        in cursor mode, numbered links are omitted then.
+        """
         if query is None: query = dict()
         if kw is None: kw = dict()
 
-        def get_query_for_page(p):
+        def get_query(name, value):
             q = query.copy()
-            q['page'] = str(p)
+            for key in ('page', 'after', 'before'):
+                if key in q:
+                    del q[key]
+            q[name] = value
             return q
 
+        def get_query_for_page(p):
+            return get_query('page', str(p))
+
+        def get_link(q):
+            return self.app.router[route].url_for(**kw).with_query(q)
+
         pages = math.ceil(count / page_size)
         list_ = []
-        for group in page_range(page, pages):
-            block = []
-            for p in group:
-                query = get_query_for_page(p)
-                link = self.app.router[route].\
-                    url_for(**kw).\
-                    with_query(query)
-                block.append({
-                    'number': str(p),
-                    'link': link,
-                    'current': page == p
-                })
-            list_.append(block)
+        if page is not None:
+            for group in page_range(page, pages):
+                block = []
+                for p in group:
+                    block.append({
+                        'number': str(p),
+                        'link': get_link(get_query_for_page(p)),
+                        'current': page == p
+                    })
+                list_.append(block)
+
         prev = None
-        if page != 1:
-            prev = dict(
-                link=self.app.router[route]
-                .url_for(**kw)
-                .with_query(**get_query_for_page(page - 1))
-            )
         next_ = None
-        if page != pages:
-            next_ = dict(
-                link=self.app.router[route]
-                .url_for(**kw)
-                .with_query(**get_query_for_page(page + 1))
-            )
+        if cursors is not None:
+            if cursors.get('prev'):
+                prev = dict(link=get_link(
+                    get_query('before', cursors['prev'])
+                ))
+            if cursors.get('next'):
+                next_ = dict(link=get_link(
+                    get_query('after', cursors['next'])
+                ))
+        else:
+            if page != 1:
+                prev = dict(link=get_link(get_query_for_page(page - 1)))
+            if page < pages:
+                next_ = dict(link=get_link(get_query_for_page(page + 1)))
         return {
             'pages': list_,
             'current': page,
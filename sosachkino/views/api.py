@@ -0,0 +1,86 @@
+import os
+import json
+from aiohttp import web
+
+from sosachkino.views import BaseView, encode_cursor, decode_cursor
+from sosachkino.video import Video
+
+
+class ApiView(BaseView):
+    """JSON API views."""
+    chunk_size = 500
+    formats = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+    }
+
+    async def videos(self, request):
+        """Stream filtered videos as NDJSON or JSON array.
+
+        Search results without after parameter are sorted by relevance
+        and have rank instead of cursor.
+        """
+        query = request.query
+        q = self.get_filter(query)
+        limit = self.get_int_param(query, 'limit', None)
+        if limit is not None:
+            q['limit'] = max(limit, 0)
+        if 'after' in query:
+            after = decode_cursor(query['after'])
+            if after is None:
+                raise web.HTTPBadRequest(text='Invalid after parameter')
+            q['after'] = after
+        format_ = query.get('format', 'ndjson')
+        if format_ not in self.formats:
+            raise web.HTTPBadRequest(text='Unknown format')
+
+        response = web.StreamResponse(headers={
+            'Content-Type': '{}; charset=utf-8'.format(self.formats[format_])
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        # Send rows as soon as every chunk is read from database
+        first = True
+        if format_ == 'json':
+            await response.write(b'[')
+        async for row in request.app['db'].iter_videos(q, self.chunk_size):
+            data = Video(row, self.base_url).as_dict()
+            if 'rank' in row:
+                data['rank'] = row['rank']
+            else:
+                # Position to continue export from with after parameter
+                data['cursor'] = encode_cursor(row['timestamp'], row['id'])
+            line = json.dumps(data, ensure_ascii=False)
+            if format_ == 'json':
+                line = line if first else ',' + line
+            else:
+                line += '\n'
+            first = False
+            await response.write(line.encode('utf-8'))
+        if format_ == 'json':
+            await response.write(b']')
+        await response.write_eof()
+        return response
+
+    async def threads(self, request):
+        """Find threads by number or subject for sidebar autocomplete."""
+        query = request.query
+        limit = min(max(self.get_int_param(query, 'limit', 20), 1), 100)
+        threads = await request.app['db'].find_threads(
+            query.get('prefix', ''), query.getall('board', []), limit
+        )
+        return web.json_response(threads)
+
+    async def updater(self, request):
+        """Get updater stats of every board.
+
+        Stats are known only to the process running updater, others
+        answer with active false and no boards.
+        """
+        updater = request.app['updater']
+        return web.json_response({
+            'active': updater.active,
+            'pid': os.getpid(),
+            'boards': updater.get_stats() if updater.active else {},
+        })
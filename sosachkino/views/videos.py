@@ -1,52 +1,125 @@
+import asyncio
 import aiohttp_jinja2
+from aiohttp import web
 
-from sosachkino.views import BaseView
+from sosachkino.api import Api
+from sosachkino.cache import LRUCache
+from sosachkino.views import BaseView, encode_cursor, decode_cursor
 from sosachkino.video import Video
 
 
 class VideosView(BaseView):
     """Videos-related views."""
     page_size = 24
+    # Next link of deeper numbered pages switches to keyset pagination
+    cursor_page = 10
 
-    def get_int_param(self, query, name, default):
-        """Get integer parameter from query with fallback value."""
-        value = default
-        try:
-            value = int(query.get(name))
-        except (TypeError, ValueError) as e:
-            pass
-        return value
+    @staticmethod
+    async def get_videos(db, filter_, base_url=Api.base_url):
+        """Get list of wrapped videos."""
+        return Video.from_rows(
+            [row async for row in db.get_videos(filter_)], base_url
+        )
+
+    def __init__(self, app):
+        super().__init__(app)
+        # Rendered pages by query string, disabled by default
+        size = app['config'].getint('app', 'response_cache', fallback=0)
+        self.responses = LRUCache(max_size=size) if size else None
+        # Others are found by autocomplete, 0 shows all of them
+        self.sidebar_threads = app['config'].getint(
+            'app', 'sidebar_threads', fallback=50
+        ) or None
+
+    def is_anonymous(self, request):
+        """Check if response doesn't depend on client."""
+        return ('Cookie' not in request.headers and
+                'Authorization' not in request.headers)
 
-    @aiohttp_jinja2.template("videos/list.jinja2")
     async def list(self, request):
-        """Paginated and filtrable list of videos."""
+        """Paginated and filtrable list of videos with conditional GET."""
+        db = request.app['db']
+        generation = db.generation
+        headers = self.get_validators(db)
+        if self.is_not_modified(request, db):
+            return web.Response(status=304, headers=headers)
+
+        use_cache = self.responses is not None and self.is_anonymous(request)
+        if use_cache:
+            body = self.responses.get(request.query_string, generation)
+            if body is not None:
+                return web.Response(body=body, headers=headers,
+                                    content_type='text/html',
+                                    charset='utf-8')
+
+        context = await self.get_list_context(request)
+        response = aiohttp_jinja2.render_template(
+            'videos/list.jinja2', request, context
+        )
+        response.headers.update(headers)
+        if use_cache:
+            self.responses.set(request.query_string, response.body,
+                               generation)
+        return response
+
+    async def get_list_context(self, request):
+        """Get template context for list of videos."""
         query = request.query;
-        videos = []
-        
+
         # Filtering
-        q = dict()
-        if 'board' in query:
-            q['board'] = query.getall('board')
-        if 'thread' in query:
-            q['thread'] = query.getall('thread')
+        q = self.get_filter(query)
 
         # Page and page size
         page_size = self.get_int_param(query, 'limit', self.page_size)
         page = self.get_int_param(query, 'page', 1)
-
         q['limit'] = page_size
-        q['offset'] = (page - 1) * page_size
 
-        boards = await request.app['db'].get_boards()
-        # Now get the videos
-        async for video in request.app['db'].get_videos(q):
-            videos.append(Video(video))
+        # Keyset position, fetch one more row to know if there is more
+        video_q = q.copy()
+        video_q['limit'] = page_size + 1
+        after = decode_cursor(query['after']) if 'after' in query else None
+        before = decode_cursor(query['before']) \
+            if 'before' in query else None
+        if after is not None:
+            video_q['after'] = after
+        elif before is not None:
+            video_q['before'] = before
+        else:
+            q['offset'] = video_q['offset'] = (page - 1) * page_size
+
+        # Queries use separate pool connections, so run them together
+        db = request.app['db']
+        boards, videos, count, threads = await asyncio.gather(
+            db.get_boards(),
+            self.get_videos(db, video_q, self.base_url),
+            db.get_videos_count(q),
+            db.get_threads(q, self.sidebar_threads)
+        )
+        has_more = len(videos) > page_size
+        if has_more:
+            # Extra row is the farthest one from the position
+            videos = videos[1:] if before is not None else videos[:-1]
 
-        count = await request.app['db'].get_videos_count(q)
-        threads = await request.app['db'].get_threads(q)
+        cursors = None
+        first = last = None
+        if videos:
+            first = encode_cursor(videos[0]['timestamp'], videos[0]['id'])
+            last = encode_cursor(videos[-1]['timestamp'], videos[-1]['id'])
+        if after is not None or before is not None:
+            page = None
+            cursors = dict(
+                prev=first if after is not None or has_more else None,
+                next=last if before is not None or has_more else None
+            )
+        elif page >= self.cursor_page and videos and 'q' not in q:
+            # Search results are sorted by relevance, not position
+            cursors = dict(
+                prev=first,
+                next=last if has_more else None
+            )
 
         pagination = self.get_pagination(
-            'videos', page, count, page_size, query
+            'videos', page, count, page_size, query, cursors=cursors
         )
 
         return {
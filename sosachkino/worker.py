@@ -0,0 +1,64 @@
+import asyncio
+import signal
+import argparse
+import configparser
+import logging
+import logging.config
+import pathlib
+
+from sosachkino import create_api
+from sosachkino.db import DB
+from sosachkino.media import create_media
+from sosachkino.updater import Updater
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(config):
+    """Run updater until cancelled."""
+    api = create_api(config)
+    db = DB(config['db'])
+    media = create_media(config, api)
+    updater = Updater(config, api, db, media)
+    await db.init(None)
+    await api.init(None)
+    if media is not None:
+        await media.init(None)
+    try:
+        await updater.run(None)
+    finally:
+        if media is not None:
+            await media.close(None)
+        await api.close(None)
+        await db.shutdown(None)
+
+
+def main():
+    """Run updater and cleanup without web server."""
+    parser = argparse.ArgumentParser(
+        description='Sosachkino background worker, only one of them '
+        'is active at the same time.'
+    )
+    parser.add_argument('--config', default=pathlib.Path.cwd() / 'config.ini',
+                        help='config file (default: ./config.ini)')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(args.config)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    logger.info('Starting worker')
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(run(config))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    finally:
+        loop.close()
+    logger.info('Worker stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import asyncio
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from sosachkino.db import DB
+
+
+def compile_(condition):
+    return str(condition.compile(dialect=postgresql.dialect(),
+                                 compile_kwargs={'literal_binds': True}))
+
+
+def test_number_prefix_ranges():
+    sql = compile_(DB.number_prefix('12', max_digits=3))
+    assert 'threads.id >= 12 AND threads.id < 13' in sql
+    assert 'threads.id >= 120 AND threads.id < 130' in sql
+
+
+def test_number_prefix_too_long():
+    condition = DB.number_prefix('9' * 20)
+    assert compile_(condition) == compile_(sa.false())
+
+
+def test_find_threads_too_long():
+    # Returns before database is touched
+    db = DB({})
+    assert asyncio.run(db.find_threads('9' * 20)) == []